@@ -30,6 +30,7 @@ WiFiUDP udp;
 
 // TCP Settings
 WiFiServer tcpServer(3001);
+WiFiClient controlClient; // last control connection is kept open so the server can send more commands (0xBB, 0xCC, 0xDD) on it
 
 volatile bool isPlaying = false;
 uint32_t mic_timeout = 0;
@@ -73,6 +74,7 @@ void gotTouch1();
 void gotTouch2();
 void gotTouch3();
 void setLed(uint8_t r, uint8_t g, uint8_t b, uint8_t level, uint8_t fade);
+bool handleControlCommand(uint8_t *header);
 void micTask(void *pvParameters);
 void updateLedTask(void *parameter);
 
@@ -437,6 +439,18 @@ void loop()
         }
     }
 
+    // commands already waiting on the persistent control connection were sent before any new connection,
+    // handle them first so e.g. a 0xDD sent while the server was thinking can't cancel the mic timeout of the reply after it
+    while (controlClient.connected() && controlClient.available() >= 6)
+    {
+        uint8_t header[6];
+        controlClient.read(header, 6);
+        if (!handleControlCommand(header))
+        {
+            controlClient.stop();
+        }
+    }
+
     WiFiClient client = tcpServer.available();
     if (client)
     {
@@ -565,68 +579,80 @@ void loop()
             Serial.println("Done loading audio in buffers in " + String(millis() - tic) + "ms");
             Serial.println("Set mic_timeout to " + String(mic_timeout));
         }
-        /*
-        header[0]   0xBB for set LED command
-        header[1]   bitmask of which LED's to set
-        header[2:4] RGB color
-        */
-        else if (header[0] == 0xBB)
+        else if (handleControlCommand(header))
         {
-            Serial.println("Received custom LED command (0xBB)");
-            setLed(0, 0, 0, 0, 0); // stop ramping down
-            uint8_t bitmask = header[1];
-            for (int i = 0; i < 6; i++)
-            {
-                if (bitmask & (1 << i))
-                {
-                    leds.setPixelColor(i, header[2], header[3], header[4]);
-                }
-            }
-            leds.show();
-            client.stop();
+            controlClient = client; // keep the connection for further commands, replaces any previous control connection
         }
-        /*
-        header[0]   0xCC for LED blink command
-        header[1]   starting intensity for rampdown
-        header[2:4] RGB color
-        header[5]   fade rate
-        */
-        else if (header[0] == 0xCC)
+        else
         {
-            Serial.println("Received LED blink command (0xCC)");
-            setLed(header[2], header[3], header[4], header[1], header[5]);
             client.stop();
+        }
+    }
+    delay(10);
+}
 
-            if(mic_timeout > millis()) // if already listening...
+// Handles LED / mic timeout commands, which can arrive on a new connection or on the persistent control connection
+// returns false for unknown commands so the caller can drop the connection
+bool handleControlCommand(uint8_t *header)
+{
+    /*
+    header[0]   0xBB for set LED command
+    header[1]   bitmask of which LED's to set
+    header[2:4] RGB color
+    */
+    if (header[0] == 0xBB)
+    {
+        Serial.println("Received custom LED command (0xBB)");
+        setLed(0, 0, 0, 0, 0); // stop ramping down
+        uint8_t bitmask = header[1];
+        for (int i = 0; i < 6; i++)
+        {
+            if (bitmask & (1 << i))
             {
-                if (mic_timeout < (millis() + VAD_MIC_EXTEND)) // and about to run out of time...
-                {
-                    mic_timeout = millis() + VAD_MIC_EXTEND; // ... extend to not cut-off
-                    Serial.println("Extended mic timeout to " + String(mic_timeout));
-                }
+                leds.setPixelColor(i, header[2], header[3], header[4]);
             }
         }
-        /*
-        header[0]   0xDD for mic timeout command - added to stop listening while server is thinking
-        header[1:2] mic timeout in seconds typically set to 0 in this use case
-        header[3:5] not used
-        */
-        else if (header[0] == 0xDD)
-        {
-            Serial.println("Received mic timeout command (0xDD)");
-            uint16_t timeout = header[1] << 8 | header[2];
-            mic_timeout = millis() + timeout;
-            setLed(0, 255, 50, 100, 5); // TODO add better thinking animation - currently just green pulse to indicate transcribe is done
-            client.stop();
-        }
-        else
+        leds.show();
+    }
+    /*
+    header[0]   0xCC for LED blink command
+    header[1]   starting intensity for rampdown
+    header[2:4] RGB color
+    header[5]   fade rate
+    */
+    else if (header[0] == 0xCC)
+    {
+        Serial.println("Received LED blink command (0xCC)");
+        setLed(header[2], header[3], header[4], header[1], header[5]);
+
+        if(mic_timeout > millis()) // if already listening...
         {
-            Serial.println("Received unknown command");
-            setLed(255, 0, 0, 255, 6);
-            client.stop();
+            if (mic_timeout < (millis() + VAD_MIC_EXTEND)) // and about to run out of time...
+            {
+                mic_timeout = millis() + VAD_MIC_EXTEND; // ... extend to not cut-off
+                Serial.println("Extended mic timeout to " + String(mic_timeout));
+            }
         }
     }
-    delay(10);
+    /*
+    header[0]   0xDD for mic timeout command - added to stop listening while server is thinking
+    header[1:2] mic timeout in seconds typically set to 0 in this use case
+    header[3:5] not used
+    */
+    else if (header[0] == 0xDD)
+    {
+        Serial.println("Received mic timeout command (0xDD)");
+        uint16_t timeout = header[1] << 8 | header[2];
+        mic_timeout = millis() + timeout;
+        setLed(0, 255, 50, 100, 5); // TODO add better thinking animation - currently just green pulse to indicate transcribe is done
+    }
+    else
+    {
+        Serial.println("Received unknown command");
+        setLed(255, 0, 0, 255, 6);
+        return false;
+    }
+    return true;
 }
 
 void micTask(void *pvParameters)
@@ -0,0 +1,175 @@
+import asyncio
+import socket
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from rich import print
+
+from ingest import detect_frame, save_utterance
+
+# asyncio only keeps weak references to tasks, hold on to fire-and-forget ones until they're done
+background_tasks = set()
+
+def spawn(awaitable):
+    task = asyncio.ensure_future(awaitable)
+    background_tasks.add(task)
+    task.add_done_callback(finished)
+    return task
+
+def finished(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"[red]Background task failed: {task.exception()!r}[/]")
+
+class UDPIngestProtocol(asyncio.DatagramProtocol):
+    """Receives audio frames from devices, runs VAD inline and hands speech to the LED dispatcher."""
+    def __init__(self, manager, queue, leds, config):
+        self.manager = manager
+        self.queue = queue
+        self.leds = leds
+        self.config = config
+
+    def submit(self, data, device, last_one):
+        self.queue.put_nowait((data, device, last_one))
+
+    def save(self, audio_data, fname, config):
+        # writing the WAV would block every device's I/O
+        spawn(asyncio.get_running_loop().run_in_executor(None, save_utterance, audio_data, fname, config))
+
+    def datagram_received(self, data, addr):
+        device = self.manager.get_device_from_ip(addr[0])  # what device sent this packet? (Needs to be added from multicast_listen)
+        if device is None:
+            return
+        try:
+            is_speech = detect_frame(self.submit, device, data, self.config, save=self.save)
+            self.leds.push(device, is_speech)  # Visualize speaking (and server listening) on LED's
+        except Exception:
+            print(traceback.format_exc())
+
+    def error_received(self, exc):
+        print(f"[red]UDP error: {exc}[/]")
+
+class MulticastProtocol(asyncio.DatagramProtocol):
+    """Listens for device announcements, registers them and sends the greeting."""
+    def __init__(self, manager, executor, config):
+        self.manager = manager
+        self.executor = executor
+        self.config = config
+
+    def datagram_received(self, data, address):
+        greet_msg = data.decode("utf-8")
+        print(
+            f"[blink]👋[/] Received [bold]{greet_msg}[/] from {address[0]}:{address[1]}"
+        )
+        host_name = greet_msg.split(" ")[0]
+        device = self.manager.create_device(host_name, address[0])
+        spawn(send_audio(device, self.executor, self.config['greeting_wav'], volume=14, fade=10, mic_timeout=30))
+
+def multicast_socket(config):
+    mcast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    mcast_sock.bind(("", config['multicast']['port']))
+    group = socket.inet_aton(config['multicast']['group'])
+    mcast_sock.setsockopt(
+        socket.IPPROTO_IP,
+        socket.IP_ADD_MEMBERSHIP,
+        group + socket.inet_aton("0.0.0.0"),
+    )
+    return mcast_sock
+
+def send_control(device, header, tcp_timeout):
+    # the persistent control channel only queues the command, otherwise open a connection without blocking the loop
+    if device.control:
+        device.control.send(header)
+    else:
+        spawn(device.send_TCP_async(header, None, tcp_timeout))
+
+async def send_audio(device, executor, fname, **kwargs):
+    # decoding/resampling is CPU bound, only the TCP transfer happens on the event loop
+    loop = asyncio.get_running_loop()
+    header, audio_data = await loop.run_in_executor(executor, lambda: device.audio_payload(fname, **kwargs))
+    await device.send_TCP_async(header, audio_data, tcp_timeout=60)
+
+async def say(device, text_response, responder, tts_executor):
+    loop = asyncio.get_running_loop()
+    if responder.stream_tts:
+        sent = await device.send_audio_stream_async(responder.speech_chunks(device, text_response), mic_timeout=10)
+        if not sent:
+            device.log.warning(f"No audio sent")
+        return
+
+    pcm = await loop.run_in_executor(tts_executor, responder.speak, device, text_response)
+    if pcm:
+        await device.send_TCP_async(device.audio_header(mic_timeout=10), pcm, tcp_timeout=60)
+    else:
+        device.log.warning(f"No audio sent")
+
+async def respond(data, device, last_one, responder, asr_executor, tts_executor):
+    loop = asyncio.get_running_loop()
+    tic = time.time()
+    res = await loop.run_in_executor(asr_executor, responder.transcribe, data, device, last_one)
+    new_res = responder.accept(res, device, last_one, tic)
+    if new_res is None:
+        return
+    if not last_one:
+        await loop.run_in_executor(None, responder.llm.speculate, device, new_res)
+        return
+
+    send_control(device, device.stop_listening_header(), 0.2)  # while server is "thinking"
+
+    # on_spoken is called from the LLM executor thread, possibly before the response is complete when streaming
+    speaking = []
+    def on_spoken(text_response):
+        speaking.append(asyncio.run_coroutine_threadsafe(say(device, text_response, responder, tts_executor), loop))
+
+    await loop.run_in_executor(None, responder.think, device, new_res, on_spoken)
+    for future in speaking:
+        await asyncio.wrap_future(future)
+    device.prune_messages()
+
+async def device_respond(utterances, responder, asr_executor, tts_executor):
+    # one task per device keeps its utterances in order while other devices run concurrently
+    while True:
+        data, device, last_one = await utterances.get()
+        try:
+            await respond(data, device, last_one, responder, asr_executor, tts_executor)
+        except Exception:
+            print(traceback.format_exc())
+
+async def transcribe_respond(queue, responder, asr_executor, tts_executor):
+    device_queues = {}
+    while True:
+        data, device, last_one = await queue.get()
+        utterances = device_queues.get(device.hostname)
+        if utterances is None:
+            utterances = device_queues[device.hostname] = asyncio.Queue()
+            spawn(device_respond(utterances, responder, asr_executor, tts_executor))
+        utterances.put_nowait((data, device, last_one))
+        queue.task_done()
+
+async def serve(manager, responder, leds, config):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    # executors are sized to the stage limits, which the Responder also enforces
+    limits = config.get('pipeline', {}).get('limits', {})
+    asr_executor = ThreadPoolExecutor(max_workers=responder.asr_concurrency, thread_name_prefix="asr")
+    tts_executor = ThreadPoolExecutor(max_workers=limits.get('tts', 1), thread_name_prefix="tts")
+
+    udp_transport, _ = await loop.create_datagram_endpoint(
+        lambda: UDPIngestProtocol(manager, queue, leds, config),
+        local_addr=(config['udp']['ip'], config['udp']['port']),
+    )
+    mcast_transport, _ = await loop.create_datagram_endpoint(
+        lambda: MulticastProtocol(manager, tts_executor, config),
+        sock=multicast_socket(config),
+    )
+    print(f"\n⚡ asyncio runtime listening on UDP {config['udp']['port']} and multicast {config['multicast']['group']}:{config['multicast']['port']}")
+
+    try:
+        await transcribe_respond(queue, responder, asr_executor, tts_executor)
+    finally:
+        udp_transport.close()
+        print("Closing multicast socket")
+        mcast_transport.close()
+        asr_executor.shutdown(wait=False)
+        tts_executor.shutdown(wait=False)
@@ -0,0 +1,205 @@
+import threading
+import time
+import warnings
+from concurrent.futures import Future
+from queue import Queue, Empty
+
+import numpy as np
+from rich import print
+
+class ASRBackend:
+    """Speech recognition engine selected with `transcribe.backend` in config.yaml.
+
+    transcribe() takes float32 mono 16kHz audio in [-1, 1] and returns the same structure as openai-whisper:
+    {"text": str, "segments": [{"text", "start", "end", "no_speech_prob"}, ...]}
+    """
+    name = None
+
+    def transcribe(self, audio, initial_prompt=None):
+        raise NotImplementedError
+
+    def transcribe_batch(self, audios, initial_prompts):
+        # engines without batched decoding fall back to one at a time
+        return [self.transcribe(audio, prompt) for audio, prompt in zip(audios, initial_prompts)]
+
+class WhisperBackend(ASRBackend):
+    """openai-whisper, runs on GPU if available."""
+    name = "whisper"
+
+    def __init__(self, config):
+        import whisper
+        self.model = whisper.load_model(config['transcribe']['whisper_model'])
+
+    def transcribe(self, audio, initial_prompt=None):
+        with warnings.catch_warnings():  # stop repeated warnings from Whisper
+            warnings.simplefilter("ignore")
+            return self.model.transcribe(audio, initial_prompt=initial_prompt)
+
+    def log_mel_batch(self, audios):
+        # same as whisper.log_mel_spectrogram but for a padded batch, clamping each item to its own max
+        import torch
+        import whisper
+        audio = torch.from_numpy(np.stack([whisper.pad_or_trim(a) for a in audios])).to(self.model.device)
+        window = torch.hann_window(whisper.audio.N_FFT).to(audio.device)
+        stft = torch.stft(audio, whisper.audio.N_FFT, whisper.audio.HOP_LENGTH, window=window, return_complex=True)
+        magnitudes = stft[..., :-1].abs() ** 2
+        mel_spec = whisper.audio.mel_filters(audio.device, self.model.dims.n_mels) @ magnitudes
+        log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+        log_spec = torch.maximum(log_spec, log_spec.amax(dim=(1, 2), keepdim=True) - 8.0)
+        return (log_spec + 4.0) / 4.0
+
+    def transcribe_batch(self, audios, initial_prompts):
+        # batched decoding only covers a single 30s window, longer utterances go through the regular path.
+        # DecodingOptions holds one prompt for the whole batch, so batched items are decoded without initial prompts,
+        # temperature fallback or timestamps. A lone short utterance gains nothing from that, it takes the regular path too
+        import whisper
+        results = [None] * len(audios)
+        short = [i for i, audio in enumerate(audios) if len(audio) <= whisper.audio.N_SAMPLES]
+        if len(short) == 1:
+            short = []
+        for i in set(range(len(audios))) - set(short):
+            results[i] = self.transcribe(audios[i], initial_prompts[i])
+        if not short:
+            return results
+
+        options = whisper.DecodingOptions(
+            language=None if self.model.is_multilingual else "en",
+            without_timestamps=True,
+            fp16=self.model.device.type == "cuda",
+        )
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            mel = self.log_mel_batch([audios[i] for i in short])
+            decoded = whisper.decode(self.model, mel, options)
+        for i, result in zip(short, decoded):
+            results[i] = {
+                "text": result.text,
+                "segments": [{
+                    "text": result.text,
+                    "start": 0.0,
+                    "end": len(audios[i]) / whisper.audio.SAMPLE_RATE,
+                    "no_speech_prob": result.no_speech_prob,
+                }] if result.text.strip() else [],
+            }
+        return results
+
+class FasterWhisperBackend(ASRBackend):
+    """CTranslate2 based faster-whisper, int8 by default for fast CPU inference."""
+    name = "faster-whisper"
+
+    def __init__(self, config):
+        from faster_whisper import WhisperModel
+        settings = config['transcribe'].get('faster_whisper', {})
+        self.beam_size = settings.get('beam_size', 1)
+        self.language = settings.get('language')
+        self.model = WhisperModel(
+            config['transcribe']['whisper_model'],
+            device=settings.get('device', 'cpu'),
+            compute_type=settings.get('compute_type', 'int8'),
+            cpu_threads=settings.get('cpu_threads', 0),
+        )
+
+    def transcribe(self, audio, initial_prompt=None):
+        segments, info = self.model.transcribe(
+            audio, initial_prompt=initial_prompt, beam_size=self.beam_size, language=self.language
+        )
+        segments = [
+            {"text": s.text, "start": s.start, "end": s.end, "no_speech_prob": s.no_speech_prob}
+            for s in segments  # segments is a generator, decoding happens here
+        ]
+        return {
+            "text": "".join(s["text"] for s in segments),
+            "segments": segments,
+            "language": info.language,
+        }
+
+class BatchTranscriber(ASRBackend):
+    """Micro-batching scheduler in front of a backend, utterances from different devices that arrive within
+    `transcribe.batch.window_ms` of each other are decoded as one batch."""
+    def __init__(self, backend, config):
+        settings = config['transcribe'].get('batch', {})
+        self.backend = backend
+        self.name = f"{backend.name} (batched)"
+        self.window = settings.get('window_ms', 50) / 1000
+        self.max_size = settings.get('max_size', 8)
+        self.report_every = settings.get('report_every', 50)
+        self.requests = Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        threading.Thread(target=self.run, name="asr-batch", daemon=True).start()
+
+    def transcribe(self, audio, initial_prompt=None):
+        future = Future()
+        self.requests.put((audio, initial_prompt, future, time.time()))
+        return future.result()
+
+    def collect(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.window
+        while len(batch) < self.max_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            started = time.time()
+            try:
+                results = self.backend.transcribe_batch([b[0] for b in batch], [b[1] for b in batch])
+                for (_, _, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+            self.record(batch, started)
+
+    def record(self, batch, started):
+        waits = [started - b[3] for b in batch]
+        with self.lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.total_wait += sum(waits)
+            self.max_wait = max(self.max_wait, *waits)
+        if self.report_every and self.batches % self.report_every == 0:
+            stats = self.stats()
+            print(f"[dim]🎤 ASR batches: {stats['batches']}, mean size {stats['mean_batch_size']:.2f} (max {stats['max_batch_size']}), "
+                  f"mean wait {stats['mean_wait_ms']:.1f}ms (max {stats['max_wait_ms']:.1f}ms)[/]")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'items': self.items,
+                'mean_batch_size': self.items / self.batches if self.batches else 0.0,
+                'max_batch_size': self.largest_batch,
+                'mean_wait_ms': 1000 * self.total_wait / self.items if self.items else 0.0,
+                'max_wait_ms': 1000 * self.max_wait,
+            }
+
+BACKENDS = {backend.name: backend for backend in [WhisperBackend, FasterWhisperBackend]}
+
+def load_asr_backend(config):
+    name = config['transcribe'].get('backend', 'whisper')
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown transcribe backend '{name}', expected one of {list(BACKENDS)}")
+
+    tic = time.time()
+    backend = BACKENDS[name](config)
+    print(
+        f"\n🎤 Loaded {name} model [bold]{config['transcribe']['whisper_model']}[/] in {time.time()-tic:.3f} seconds\n"
+    )
+    if config['transcribe'].get('batch', {}).get('enabled', False):
+        backend = BatchTranscriber(backend, config)
+        print(f"🎤 Batching transcriptions within {backend.window * 1000:.0f}ms windows (max {backend.max_size})")
+    return backend
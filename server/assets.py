@@ -0,0 +1,63 @@
+import glob
+import os
+import threading
+
+import numpy as np
+from pydub import AudioSegment
+from rich import print
+
+class AudioAssets:
+    """Static clips under `audio_dir` (greetings etc.) decoded once into device-format PCM (16kHz mono int16).
+
+    Decoded audio is written to `assets.cache_dir` and memory-mapped, so restarts don't decode again either.
+    A clip is decoded again when its source file's mtime changes. Files in `assets.preload` are loaded at startup,
+    anything else on first use.
+    """
+    def __init__(self, config):
+        settings = config.get('assets', {})
+        self.audio_dir = config['audio_dir']
+        self.cache_dir = settings.get('cache_dir', os.path.join(self.audio_dir, 'pcm_cache'))
+        self.clips = {} # fname -> (source mtime_ns, PCM memmap)
+        self.lock = threading.Lock()
+        self.decodes = 0
+        for fname in settings.get('preload', [config['greeting_wav']]):
+            self.get(fname)
+
+    def get(self, fname):
+        """Device-format PCM of a clip in audio_dir, as an int16 array."""
+        mtime = os.stat(os.path.join(self.audio_dir, fname)).st_mtime_ns
+        clip = self.clips.get(fname)
+        if clip is not None and clip[0] == mtime:
+            return clip[1]
+        with self.lock: # only one decode per clip when every device asks at once
+            clip = self.clips.get(fname)
+            if clip is None or clip[0] != mtime:
+                clip = self.clips[fname] = (mtime, self.load(fname, mtime))
+        return clip[1]
+
+    def cache_path(self, fname, mtime):
+        return os.path.join(self.cache_dir, f"{fname}.{mtime}.pcm")
+
+    def load(self, fname, mtime):
+        path = self.cache_path(fname, mtime)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pcm = (
+                AudioSegment.from_file(os.path.join(self.audio_dir, fname))
+                .set_channels(1)
+                .set_frame_rate(16000)
+                .set_sample_width(2)
+                .raw_data
+            )
+            with open(f"{path}.tmp", 'wb') as f:
+                f.write(pcm)
+            os.replace(f"{path}.tmp", path)
+            self.decodes += 1
+            # drop versions decoded from older copies of the file
+            for stale in glob.glob(glob.escape(os.path.join(self.cache_dir, fname)) + ".*.pcm"):
+                if stale != path:
+                    os.remove(stale)
+            print(f"🔈 Decoded [bold]{fname}[/] into {path}")
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=np.int16) # can't memory-map an empty file
+        return np.memmap(path, dtype=np.int16, mode='r')
@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+
+from rich import print
+
+class ContextBudget:
+    """Counts real tokens and trims conversation history at turn boundaries to fit KoboldCPP's context window.
+
+    Token counts are cached per text, so each turn only tokenizes the newly added messages.
+    `kobold.tokenizer` selects the counter: "kobold" (the /api/extra/tokencount endpoint), a Hugging Face
+    tokenizer name (needs transformers), or "estimate" (~4 characters per token).
+    """
+    def __init__(self, kobold, config):
+        settings = config.get('kobold', {})
+        self.kobold = kobold
+        self.max_context_length = settings.get('max_context_length', 2048)
+        self.max_length = settings.get('max_length', 200)
+        self.max_history_tokens = settings.get('max_history_tokens', 1000)
+        self.margin = settings.get('token_margin', 16) # tokens merge differently at turn boundaries, keep some slack
+        self.tokenizer_name = settings.get('tokenizer', 'kobold')
+        self.tokenizer = None
+        self.cache = OrderedDict() # text -> token count
+        self.cache_size = 4096
+        self.lock = threading.Lock()
+
+        if self.tokenizer_name not in ('kobold', 'estimate'):
+            from transformers import AutoTokenizer
+            self.tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+            print(f"🔢 Counting tokens with [bold]{self.tokenizer_name}[/]")
+
+    def count(self, text):
+        with self.lock:
+            if text in self.cache:
+                self.cache.move_to_end(text)
+                return self.cache[text]
+
+        tokens = self.tokenize(text)
+        if tokens is None:
+            return len(text) // 4 + 1 # don't cache estimates, the endpoint may be back next turn
+
+        with self.lock:
+            self.cache[text] = tokens
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return tokens
+
+    def tokenize(self, text):
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        if self.tokenizer_name == 'estimate':
+            return len(text) // 4 + 1
+        try:
+            response = self.kobold.post("/extra/tokencount", json={"prompt": text}, timeout=2)
+            if response.status_code == 200:
+                return response.json()['value']
+            print(f"[orange1]Token count failed with status {response.status_code}, estimating[/]")
+        except Exception as e:
+            print(f"[orange1]Token count failed ({e}), estimating[/]")
+        return None
+
+    def fit(self, system_prompt, turns, new_turn):
+        """Returns how many of the most recent turns fit alongside the system prompt, the new turn and the reply."""
+        available = (
+            self.max_context_length - self.max_length - self.margin
+            - self.count(system_prompt) - self.count(new_turn)
+        )
+        available = min(available, self.max_history_tokens)
+
+        used = 0
+        kept = 0
+        for turn in reversed(turns):
+            used += self.count(turn)
+            if used > available:
+                break
+            kept += 1
+        return kept
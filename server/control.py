@@ -0,0 +1,132 @@
+import select
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+try:
+    import fcntl
+    from termios import TIOCOUTQ # same value as SIOCOUTQ, bytes the kernel hasn't had acknowledged yet
+except ImportError: # Windows
+    fcntl = TIOCOUTQ = None
+
+LED_BLINK = 0xcc
+
+class ControlChannel:
+    """Long-lived TCP connection to a device for control commands (0xBB, 0xCC, 0xDD).
+
+    Commands are queued and written by a per-device thread, so callers never block on the network.
+    LED blinks are coalesced: a blink is only written once the socket has no unsent bytes, until then newer
+    blinks replace it, so a slow link shows the current level rather than a backlog of stale ones.
+    Dropped connections are re-established with exponential backoff.
+    """
+    def __init__(self, device, config):
+        settings = config.get('control', {})
+        self.device = device
+        self.port = config['tcp_port']
+        self.timeout = settings.get('timeout', 0.5)
+        self.backoff_min = settings.get('backoff_min', 0.5)
+        self.backoff_max = settings.get('backoff_max', 30)
+        self.backoff = self.backoff_min
+        self.retry_at = 0
+        self.sock = None
+        self.ip_address = None
+
+        self.commands = deque() # non-LED commands, sent in order
+        self.led = None # newest pending LED blink, replaces older ones
+        self.coalesced = 0
+        self.dropped = 0
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def send(self, header):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=f"control-{self.device.hostname}", daemon=True)
+                self.thread.start()
+            if header[0] == LED_BLINK:
+                if self.led is not None:
+                    self.coalesced += 1
+                self.led = header
+            else:
+                self.commands.append(header)
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.commands and self.led is None:
+                    self.cond.wait()
+                if self.commands:
+                    header = self.commands.popleft()
+                elif self.backlogged():
+                    self.cond.wait(0.02)
+                    continue
+                else:
+                    header, self.led = self.led, None
+            self.write(header)
+
+    def backlogged(self):
+        # only the writer thread touches the socket
+        if self.sock is None or TIOCOUTQ is None:
+            return False
+        try:
+            return struct.unpack("i", fcntl.ioctl(self.sock.fileno(), TIOCOUTQ, b"\0\0\0\0"))[0] > 0
+        except OSError:
+            return False
+
+    def write(self, header):
+        # LED blinks aren't worth waiting for a reconnect, other commands ignore the backoff
+        for attempt in range(2):
+            if not self.connected() and not self.connect(force=header[0] != LED_BLINK):
+                self.dropped += 1
+                return
+            try:
+                self.sock.sendall(header)
+                return
+            except OSError as e:
+                self.device.log.debug(f"Control connection lost: {e}")
+                self.close()
+        self.dropped += 1
+
+    def connected(self):
+        if self.sock is None:
+            return False
+        if self.ip_address != self.device.ip_address:
+            self.close() # device got a new IP from DHCP
+            return False
+        try:
+            # readable with no data means the device closed the connection (reboot, old firmware)
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if readable and self.sock.recv(1, socket.MSG_PEEK) == b"":
+                self.close()
+                return False
+        except OSError:
+            self.close()
+            return False
+        return True
+
+    def connect(self, force=False):
+        if not force and time.time() < self.retry_at:
+            return False
+        try:
+            sock = socket.create_connection((self.device.ip_address, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if TIOCOUTQ is None:
+                # can't see the send queue, keep it small so few blinks can pile up in it
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            self.sock = sock
+            self.ip_address = self.device.ip_address
+            self.backoff = self.backoff_min
+            return True
+        except OSError as e:
+            self.retry_at = time.time() + self.backoff
+            self.device.log.warning(f"Control connection failed ({e}), retrying in {self.backoff:.1f}s")
+            self.backoff = min(2 * self.backoff, self.backoff_max)
+            return False
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
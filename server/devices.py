@@ -1,11 +1,14 @@
+import asyncio
 import json
 import logging
 import os
 import socket
-import time
+import numpy as np
 import webrtcvad
 
 from collections import deque
+from assets import AudioAssets
+from control import ControlChannel
 from pydub import AudioSegment
 from logging import Formatter
 from rich.logging import RichHandler
@@ -19,39 +22,131 @@ class CustomFormatter(Formatter):
         else:
             return f"[orange1][bold]{record.name}[/bold][/orange1]: {record.msg}"
 
+class AudioBuffer:
+    """Growable contiguous numpy arena holding the samples of the utterance being recorded."""
+    def __init__(self, dtype, capacity):
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self.reset()
+
+    def reset(self):
+        # always start a fresh arena rather than rewinding, views handed to the transcribe queue must stay valid
+        self.data = np.empty(self.capacity, dtype=self.dtype)
+        self.length = 0
+
+    def append(self, frame):
+        n = len(frame)
+        if self.length + n > len(self.data):
+            data = np.empty(max(self.length + n, 2 * len(self.data)), dtype=self.dtype)
+            data[:self.length] = self.data[:self.length]
+            self.data = data
+        self.data[self.length:self.length + n] = frame
+        self.length += n
+
+    def extend(self, frames):
+        for frame in frames:
+            self.append(frame)
+
+    def view(self):
+        # zero-copy, later appends only write past self.length (or into a new arena when growing)
+        audio = self.data[:self.length]
+        audio.flags.writeable = False
+        return audio
+
+    def __len__(self):
+        return self.length
+
 class Vad:
     def __init__(self, config):
         self.config = config
-        self.led_update_time = time.time()
         self.vad = webrtcvad.Vad(3)
 
         FRAMES_PER_SECOND = int(self.config['mic']['rate'] / self.config['mic']['chunk'])
         WINDOW_FRAMES = int(self.config['vad']['window_length'] * FRAMES_PER_SECOND)
         PREBUFFER_FRAMES = int(self.config['vad']['pre_buffer_length'] * FRAMES_PER_SECOND)
         
+        BUFFER_SAMPLES = int(self.config['vad'].get('buffer_length', 10) * self.config['mic']['rate'])
+
+        self.rate = self.config['mic']['rate']
+        # energy pre-gate, frames below gate_rms (or quiet & noisy above gate_zcr) are treated as silence without running webrtcvad
+        self.gate_rms = self.config['vad'].get('gate_rms', 0)
+        self.gate_zcr = self.config['vad'].get('gate_zcr', 1.0)
+        self.gated_frames = 0
+
         self.window = deque(maxlen=WINDOW_FRAMES)
+        self.speech_count = 0 # running count of speech frames in self.window
         self.pre_buffer = deque(maxlen=PREBUFFER_FRAMES)
-        self.buffer = []
+        self.buffer = AudioBuffer(self.config['mic']['format'], BUFFER_SAMPLES)
         self.recording = False
         self.silence_count = 0
         self.frame_count = 0
         self.new_segment = True
-        self.led_power = 0
         self.fname = None
 
     def reset(self):
-        self.buffer = []
+        self.buffer.reset()
         self.recording = False
         self.silence_count = 0
         self.frame_count = 0
         self.window.clear()
+        self.speech_count = 0
+
+    def gate(self, frames):
+        # frames: (n, chunk) array, returns a mask of frames that are clearly silent
+        samples = frames.astype(np.float32)
+        rms = np.sqrt(np.mean(samples * samples, axis=1))
+        zcr = np.mean((frames[:, 1:] ^ frames[:, :-1]) < 0, axis=1)
+        return (rms < self.gate_rms) | ((rms < 2 * self.gate_rms) & (zcr > self.gate_zcr))
+
+    def is_silent(self, frame):
+        # single frame version of gate, has to cost less than the webrtcvad call it saves: one dot product for the
+        # energy (compared squared, no sqrt), and the zero-crossing rate only for frames in the ambiguous band
+        samples = frame.astype(np.float32)
+        energy = np.dot(samples, samples)
+        threshold = self.gate_rms * self.gate_rms * len(frame)
+        if energy < threshold:
+            return True
+        if energy < 4 * threshold: # rms < 2x gate_rms
+            # neighbours with different signs xor to a negative number
+            return np.count_nonzero((frame[1:] ^ frame[:-1]) < 0) > self.gate_zcr * (len(frame) - 1)
+        return False
+
+    def is_speech(self, data, frame):
+        if self.gate_rms > 0 and self.is_silent(frame):
+            self.gated_frames += 1
+            return False
+        return self.vad.is_speech(data, self.rate)
+
+    def classify(self, frames):
+        # batch version of is_speech for a backlog of frames, only frames passing the gate go to webrtcvad
+        frames = np.asarray(frames)
+        is_speech = np.zeros(len(frames), dtype=bool)
+        candidates = np.flatnonzero(~self.gate(frames)) if self.gate_rms > 0 else np.arange(len(frames))
+        self.gated_frames += len(frames) - len(candidates)
+        for i in candidates:
+            is_speech[i] = self.vad.is_speech(frames[i].tobytes(), self.rate)
+        return is_speech
+
+    def push(self, is_speech):
+        # O(1) update of the running window count
+        if len(self.window) == self.window.maxlen:
+            self.speech_count -= self.window[0]
+        self.window.append(bool(is_speech))
+        self.speech_count += bool(is_speech)
+
+    def full(self):
+        return len(self.window) == self.window.maxlen
+
+    def ratio(self):
+        return self.speech_count / len(self.window) if self.window else 0.0
 
     def visualization(self):
         return "["+"".join(["*" if x else "-" for x in self.window])+"]"
 
 class Device:
-    def __init__(self, hostname, ip_address, config, messages=None, voice=None):
+    def __init__(self, hostname, ip_address, config, messages=None, voice=None, assets=None):
         self.config = config
+        self.assets = assets # shared AudioAssets, decoded clips for send_audio
         self.hostname = hostname
         self.ip_address = ip_address
         self.messages = self.init_messages(messages)
@@ -59,6 +154,7 @@ class Device:
         self.last_response = None
         self.vad = Vad(self.config)
         self.log = self.setup_logger()
+        self.control = ControlChannel(self, self.config) if self.config.get('control', {}).get('persistent', False) else None
         self.voice = self.config["kokoro_default_voice"] if voice is None else voice
 
     def construct_init_prompt(self):
@@ -105,12 +201,13 @@ class Device:
         return logger
 
     def send_audio(self, fname, mic_timeout=5 * 60, volume=13, fade=10):
-        # header[0]   0xAA for audio
-        # header[1:2] mic timeout in seconds (after audio is done playing)
-        # header[3]   volume
-        # header[4]   fade rate of LED's VAD visualization
-        # header[5]   not used
-        header = bytes([0xaa, (mic_timeout & 0xff00) >> 8, mic_timeout & 0xff, volume, fade, 0])
+        header, audio_data = self.audio_payload(fname, mic_timeout, volume, fade)
+        self.send_TCP(header, audio_data, tcp_timeout=60) # 60 (!!) second tcp_timeout for audio as we currently read bytes from TCP as I2S buffer frees up
+
+    def audio_payload(self, fname, mic_timeout=5 * 60, volume=13, fade=10):
+        header = self.audio_header(mic_timeout, volume, fade)
+        if self.assets is not None:
+            return header, memoryview(self.assets.get(fname)).cast('B') # no copy of the memory-mapped clip
         audio_data = (
             AudioSegment.from_file(os.path.join(self.config['audio_dir'], fname))
             .set_channels(1)
@@ -118,34 +215,91 @@ class Device:
             .set_sample_width(2)
             .raw_data
         )
-        self.send_TCP(header, audio_data, tcp_timeout=60) # 60 (!!) second tcp_timeout for audio as we currently read bytes from TCP as I2S buffer frees up
+        return header, audio_data
+
+    def send_pcm(self, pcm, mic_timeout=5 * 60, volume=13, fade=10):
+        # pcm is already in device format (16kHz mono int16)
+        self.send_TCP(self.audio_header(mic_timeout, volume, fade), pcm, tcp_timeout=60)
+
+    def audio_header(self, mic_timeout=5 * 60, volume=13, fade=10):
+        # header[0]   0xAA for audio
+        # header[1:2] mic timeout in seconds (after audio is done playing)
+        # header[3]   volume
+        # header[4]   fade rate of LED's VAD visualization
+        # header[5]   not used
+        return bytes([0xaa, (mic_timeout & 0xff00) >> 8, mic_timeout & 0xff, volume, fade, 0])
+
+    def send_audio_stream(self, chunks, mic_timeout=5 * 60, volume=13, fade=10):
+        # the device plays audio until the connection closes, so chunks are written to one open connection as they're
+        # produced. Connects once the first chunk is ready, returns False if there was nothing to send
+        s = None
+        try:
+            for chunk in chunks:
+                if s is None:
+                    s = socket.create_connection((self.ip_address, self.config['tcp_port']), timeout=60)
+                    s.sendall(self.audio_header(mic_timeout, volume, fade))
+                s.sendall(chunk)
+        except socket.timeout:
+            self.log.error(f"TCP timeout streaming audio (60 seconds)")
+        except Exception as e:
+            self.log.error(f"TCP error: {e}")
+        finally:
+            if s is not None:
+                s.close()
+        return s is not None
+
+    async def send_audio_stream_async(self, chunks, mic_timeout=5 * 60, volume=13, fade=10):
+        # asyncio equivalent of send_audio_stream, chunks is a blocking iterator so it's advanced in an executor
+        loop = asyncio.get_running_loop()
+        writer = None
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                if writer is None:
+                    _, writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.ip_address, self.config['tcp_port']), 60
+                    )
+                    writer.write(self.audio_header(mic_timeout, volume, fade))
+                writer.write(chunk)
+                await asyncio.wait_for(writer.drain(), 60)
+        except asyncio.TimeoutError:
+            self.log.error(f"TCP timeout streaming audio (60 seconds)")
+        except Exception as e:
+            self.log.error(f"TCP error: {e}")
+        finally:
+            if writer is not None:
+                writer.close()
+        return writer is not None
 
     def prune_messages(self):
         while(len(self.messages) > self.config['llm']['max_messages']):
             self.log.debug(f"Pruning message: {self.messages[1]['role']}")
             self.messages.pop(1)
 
-    def update_LEDs(self, is_speech):
-        if(is_speech): # accumulate power until ready to update LED's
-            self.vad.led_power = min(255, self.vad.led_power + self.config['led']['power'])
-
-        if(time.time() - self.vad.led_update_time > self.config['led']['update_period']):
-            self.vad.led_update_time = time.time()
-            if(self.vad.led_power > 0):
-                # header[0]   0xCC for LED blink command
-                # header[1]   starting intensity for rampdown
-                # header[2:4] RGB color
-                # header[5]   fade rate
-                header = bytes([0xcc, self.vad.led_power, 255, 255, 255, self.config['led']['fade']])
-                self.send_TCP(header, None, 0.1)
-            self.vad.led_power = 0
+    def led_blink_header(self, power):
+        # header[0]   0xCC for LED blink command
+        # header[1]   starting intensity for rampdown
+        # header[2:4] RGB color
+        # header[5]   fade rate
+        return bytes([0xcc, power, 255, 255, 255, self.config['led']['fade']])
 
     def stop_listening(self):
+        self.send_control(self.stop_listening_header(), 0.2)
+
+    def stop_listening_header(self):
         # header[0]   0xDD for mic timeout command
         # header[1:2] mic timeout in seconds
         # header[3:5] not used
-        header = bytes([0xdd, 0, 0, 0, 0, 0])
-        self.send_TCP(header, None, 0.2)
+        return bytes([0xdd, 0, 0, 0, 0, 0])
+
+    def send_control(self, header, tcp_timeout):
+        # control commands go over the persistent connection if enabled, otherwise a connection per command
+        if self.control:
+            self.control.send(header)
+        else:
+            self.send_TCP(header, None, tcp_timeout)
 
     def send_TCP(self, header, data, tcp_timeout):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -162,6 +316,25 @@ class Device:
         finally:
             s.close()
 
+    async def send_TCP_async(self, header, data, tcp_timeout):
+        # asyncio equivalent of send_TCP for the asyncio runtime
+        writer = None
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.ip_address, self.config['tcp_port']), tcp_timeout
+            )
+            writer.write(header)
+            if(data):
+                writer.write(data)
+            await asyncio.wait_for(writer.drain(), tcp_timeout)
+        except asyncio.TimeoutError:
+            self.log.error(f"TCP timeout sending {'header' if data is None else 'data'} ({tcp_timeout} seconds)")
+        except Exception as e:
+            self.log.error(f"TCP error: {e}")
+        finally:
+            if writer is not None:
+                writer.close()
+
 
     def to_dict(self):
         return {
@@ -172,8 +345,8 @@ class Device:
         }
 
     @classmethod
-    def from_dict(cls, data, config):
-        return cls(data['hostname'], data['ip_address'], config, data.get('messages', data['voice']))
+    def from_dict(cls, data, config, assets=None):
+        return cls(data['hostname'], data['ip_address'], config, data.get('messages', data['voice']), assets=assets)
 
     def __repr__(self):
         return f"{self.hostname} {self.ip_address} [{len(self.messages) - 1} messages]"
@@ -181,27 +354,38 @@ class Device:
 class DeviceManager:
     def __init__(self, config):
         self.devices = {}
+        self.ip_index = {} # ip_address -> Device, kept in sync with self.devices for O(1) lookups per UDP packet
         self.config = config
+        self.assets = AudioAssets(config)
         self.load_from_json()
 
     def create_device(self, hostname, ip_address):
         device = self.devices.get(hostname)
         if device is None:
-            device = Device(hostname, ip_address, self.config)
+            device = Device(hostname, ip_address, self.config, assets=self.assets)
             self.devices[hostname] = device
+            self.index_device(device)
             device.log.info(f'Created new device with IP {ip_address}')
         elif device.ip_address != ip_address:
+            old_ip_address = device.ip_address
             device.ip_address = ip_address
+            self.index_device(device, old_ip_address)
             device.log.info(f'Updated IP address to {ip_address}')
         else:
             device.log.info(f'Device already exists with IP {ip_address}')
         return device
 
+    def index_device(self, device, old_ip_address=None):
+        # only drop the old entry if it still points at this device (DHCP may have handed the IP to another unit)
+        if old_ip_address is not None and self.ip_index.get(old_ip_address) is device:
+            del self.ip_index[old_ip_address]
+        self.ip_index[device.ip_address] = device
+
+    def rebuild_index(self):
+        self.ip_index = {device.ip_address: device for device in self.devices.values()}
+
     def get_device_from_ip(self, ip_address):
-        for device in self.devices.values():
-            if device.ip_address == ip_address:
-                return device
-        return None
+        return self.ip_index.get(ip_address)
     
     def save_to_json(self):
         print(f"Saving devices to {self.config['devices_file']}")
@@ -215,7 +399,8 @@ class DeviceManager:
                 try:
                     json_devices = json.load(f)
                     if(len(json_devices) > 0):
-                        self.devices = {k: Device.from_dict(v, self.config) for k, v in json_devices.items()}
+                        self.devices = {k: Device.from_dict(v, self.config, self.assets) for k, v in json_devices.items()}
+                        self.rebuild_index()
                         print(f"\n🍐 Loaded {len(self.devices)} devices from [bold]{self.config['devices_file']}[/]:")
                         for device in self.devices.values():
                             print(f"{device.hostname} \t [dim]{device.ip_address}[/] \tMessages: {len(device.messages)}")
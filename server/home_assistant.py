@@ -0,0 +1,149 @@
+import json
+import threading
+import time
+import traceback
+
+from rich import print
+
+class EntityCache:
+    """In-memory copy of Home Assistant entity states, kept up to date in the background.
+
+    States are loaded in bulk from /api/states, then updated from `state_changed` events on HA's websocket API
+    (needs websocket-client) or by re-polling /api/states every `home_assistant.poll_interval` as a fallback.
+    A websocket that's quiet for `home_assistant.heartbeat` seconds gets a ping, and is reconnected if HA doesn't
+    answer within the same time, so a half-open connection (HA host rebooted) doesn't leave the cache stale.
+    Listeners registered with on_change() are called when entities are added or removed.
+    """
+    def __init__(self, client, config):
+        settings = config.get('home_assistant', {})
+        self.client = client
+        self.refresh = settings.get('refresh', 'websocket')
+        self.poll_interval = settings.get('poll_interval', 10)
+        self.backoff_max = settings.get('backoff_max', 60)
+        self.heartbeat = settings.get('heartbeat', 30)
+        self.backoff = 1
+        self.states = {} # entity_id -> state object as returned by /api/states
+        self.loaded = False
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.updates = 0
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="ha-entities", daemon=True)
+            self.thread.start()
+
+    def on_change(self, callback):
+        self.listeners.append(callback)
+
+    def get(self, entity_id):
+        """Full state object of an entity, or None if it doesn't exist. Treat it as read-only."""
+        return self.states.get(entity_id)
+
+    def state(self, entity_id, default=None):
+        state = self.states.get(entity_id)
+        return state['state'] if state else default
+
+    def all(self):
+        with self.lock:
+            return sorted(self.states.values(), key=lambda s: s['entity_id'])
+
+    def domain(self, domain):
+        return [s for s in self.all() if s['entity_id'].startswith(f"{domain}.")]
+
+    def load(self):
+        response = self.client.get("api/states")
+        response.raise_for_status()
+        self.replace(response.json())
+
+    def replace(self, states):
+        states = {s['entity_id']: s for s in states}
+        with self.lock:
+            changed = states.keys() != self.states.keys()
+            self.states = states
+            self.loaded = True
+        if changed:
+            self.notify()
+
+    def apply(self, states):
+        """Merge state objects, e.g. the changed states returned by a service call."""
+        for state in states:
+            self.update(state['entity_id'], state)
+
+    def update(self, entity_id, new_state):
+        # new_state is None when the entity was removed
+        with self.lock:
+            old_state = self.states.get(entity_id)
+            if old_state and new_state and new_state.get('last_updated', '') < old_state.get('last_updated', ''):
+                return # event queued before the last bulk load
+            changed = (old_state is not None) != (new_state is not None)
+            if new_state is None:
+                self.states.pop(entity_id, None)
+            else:
+                self.states[entity_id] = new_state
+            self.updates += 1
+        if changed:
+            self.notify()
+
+    def notify(self):
+        for callback in self.listeners:
+            try:
+                callback()
+            except Exception:
+                print(traceback.format_exc())
+
+    def run(self):
+        while True:
+            if self.refresh == 'websocket':
+                try:
+                    self.listen()
+                except ImportError:
+                    print("[orange1]websocket-client not installed, polling Home Assistant states instead[/]")
+                    self.refresh = 'poll'
+                except Exception as e:
+                    print(f"[orange1]Home Assistant event stream failed ({e}), reconnecting in {self.backoff}s[/]")
+                    time.sleep(self.backoff)
+                    self.backoff = min(2 * self.backoff, self.backoff_max)
+            else:
+                time.sleep(self.poll_interval)
+                try:
+                    self.load()
+                except Exception as e:
+                    print(f"[orange1]Polling Home Assistant states failed: {e}[/]")
+
+    def listen(self):
+        import websocket
+        url = self.client.url("api/websocket").replace("http", "ws", 1)
+        ws = websocket.create_connection(url, timeout=self.client.timeout)
+        try:
+            ws.recv() # auth_required
+            ws.send(json.dumps({"type": "auth", "access_token": self.client.credentials.get('home_assistant_token')}))
+            message = json.loads(ws.recv())
+            if message.get('type') != 'auth_ok':
+                raise RuntimeError(f"authentication failed: {message.get('message', message.get('type'))}")
+            self.backoff = 1
+            ws.send(json.dumps({"id": 1, "type": "subscribe_events", "event_type": "state_changed"}))
+
+            # reload after subscribing so nothing that changed while disconnected is missed
+            self.load()
+            print(f"🏡 Following Home Assistant state changes ({len(self.states)} entities)")
+            ws.settimeout(self.heartbeat)
+            ping_id = 1
+            pinged = False
+            while True:
+                try:
+                    message = json.loads(ws.recv())
+                except websocket.WebSocketTimeoutException:
+                    if pinged:
+                        raise RuntimeError(f"no answer to ping within {self.heartbeat}s")
+                    ping_id += 1
+                    ws.send(json.dumps({"id": ping_id, "type": "ping"}))
+                    pinged = True
+                    continue
+                pinged = False # anything from HA shows the connection is alive
+                if message.get('type') == 'event':
+                    data = message['event']['data']
+                    self.update(data['entity_id'], data.get('new_state'))
+        finally:
+            ws.close()
@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from rich import print
+
+class Credentials:
+    """credentials.json, loaded once and reloaded when the file changes."""
+    def __init__(self, path='credentials.json'):
+        self.path = path
+        self.mtime = None
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self.reload_if_changed()
+        return self.data.get(key, default)
+
+    def reload_if_changed(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime != self.mtime:
+                with open(self.path, 'r') as f:
+                    self.data = json.load(f)
+                if self.mtime is not None:
+                    print(f"🔑 Reloaded [bold]{self.path}[/]")
+                self.mtime = mtime
+
+class UpstreamClient:
+    """Keep-alive connection pool to one upstream with a default timeout, bounded retries and per-endpoint latency stats.
+
+    Failed connections are retried for any method, nothing was sent yet. 502/503/504 responses are only retried for
+    idempotent methods: a POST that got one may still have been processed (a generation, a Home Assistant service
+    call), so it isn't resent.
+    """
+    def __init__(self, name, base_url, timeout, retries=2, pool_size=8):
+        self.name = name
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries, connect=retries, read=0, status=retries,
+            status_forcelist=(502, 503, 504), allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, backoff_factor=0.2,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.latency = {} # endpoint -> [count, total seconds, max seconds]
+        self.lock = threading.Lock()
+
+    def url(self, path):
+        return f"{self.base_url}{path}"
+
+    def headers(self):
+        return {}
+
+    def request(self, method, path, timeout=None, **kwargs):
+        headers = {**self.headers(), **kwargs.pop('headers', {})}
+        tic = time.time()
+        try:
+            return self.session.request(
+                method, self.url(path), headers=headers, timeout=timeout or self.timeout, **kwargs
+            )
+        finally:
+            self.record(path, time.time() - tic)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def record(self, path, elapsed):
+        with self.lock:
+            stats = self.latency.setdefault(path, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    def stats(self):
+        with self.lock:
+            return {
+                path: {'count': count, 'mean_ms': 1000 * total / count, 'max_ms': 1000 * longest}
+                for path, (count, total, longest) in self.latency.items()
+            }
+
+class HomeAssistantClient(UpstreamClient):
+    """Home Assistant REST API, URL and token come from credentials.json so they follow edits to the file."""
+    def __init__(self, credentials, timeout, retries=2, pool_size=8):
+        super().__init__('home_assistant', None, timeout, retries, pool_size)
+        self.credentials = credentials
+
+    def url(self, path):
+        return f"{self.credentials.get('home_assistant_url')}{path}"
+
+    def headers(self):
+        return {
+            "Authorization": f"Bearer {self.credentials.get('home_assistant_token')}",
+            "content-type": "application/json",
+        }
+
+class HTTPClients:
+    """Shared HTTP clients for every upstream the server talks to."""
+    def __init__(self, config):
+        settings = config.get('http', {})
+        retries = settings.get('retries', 2)
+        pool_size = settings.get('pool_size', 8)
+        self.credentials = Credentials(settings.get('credentials_file', 'credentials.json'))
+        self.kobold = UpstreamClient(
+            'kobold', config.get('kobold', {}).get('url', 'http://localhost:5001/api'),
+            settings.get('kobold_timeout', 120), retries, pool_size,
+        )
+        # generation slots, the first is the main KoboldCPP instance
+        self.kobold_slots = [self.kobold] + [
+            UpstreamClient(f'kobold[{i}]', url, settings.get('kobold_timeout', 120), retries, pool_size)
+            for i, url in enumerate(config.get('kobold', {}).get('urls') or [], start=1)
+        ]
+        self.home_assistant = HomeAssistantClient(
+            self.credentials, settings.get('home_assistant_timeout', 5), retries, pool_size,
+        )
+
+    def report(self):
+        for client in self.kobold_slots + [self.home_assistant]:
+            for path, stats in client.stats().items():
+                print(f"[dim]🌐 {client.name} {path}: {stats['count']} calls, mean {stats['mean_ms']:.0f}ms, max {stats['max_ms']:.0f}ms[/]")
@@ -0,0 +1,149 @@
+import os
+import socket
+import threading
+import traceback
+from datetime import datetime
+from queue import Queue, Full
+
+import numpy as np
+from scipy.io.wavfile import write
+from rich import print
+
+class DeviceWorker:
+    """Bounded frame queue and VAD worker thread for a single device."""
+    def __init__(self, device, handler, maxsize):
+        self.device = device
+        self.handler = handler
+        self.frames = Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name=f"vad-{device.hostname}", daemon=True)
+        self.thread.start()
+
+    def put(self, data):
+        # never block the receive loop, a slow device only loses its own frames
+        try:
+            self.frames.put_nowait(data)
+        except Full:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                self.device.log.warning(f"Frame queue full, dropped {self.dropped} frames so far")
+
+    def run(self):
+        while True:
+            data = self.frames.get()
+            try:
+                self.handler(self.device, data)
+            except Exception:
+                print(traceback.format_exc())
+            finally:
+                self.frames.task_done()
+
+class FrameIngest:
+    """Receives UDP audio from all devices and shards frames out to per-device workers."""
+    def __init__(self, manager, handler, config):
+        self.manager = manager
+        self.handler = handler
+        self.config = config
+        self.addr_port = (config['udp']['ip'], config['udp']['port'])
+        self.chunk_bytes = config['mic']['chunk'] * np.dtype(config['mic']['format']).itemsize
+        self.queue_size = config['udp'].get('frame_queue', 64)
+        self.workers = {} # hostname -> DeviceWorker, keyed by hostname so workers survive IP changes
+
+    def worker_for(self, device):
+        worker = self.workers.get(device.hostname)
+        if worker is None or worker.device is not device:
+            worker = DeviceWorker(device, self.handler, self.queue_size)
+            self.workers[device.hostname] = worker
+            device.log.debug(f"Started frame worker (queue size {self.queue_size})")
+        return worker
+
+    def dispatch(self, data, addr):
+        device = self.manager.get_device_from_ip(addr[0])  # what device sent this packet? (Needs to be added from multicast_listen)
+        if device:
+            self.worker_for(device).put(data)
+
+    def serve_forever(self):
+        while True:
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                    s.bind(self.addr_port)
+                    while True:
+                        data, addr = s.recvfrom(self.chunk_bytes)
+                        self.dispatch(data, addr)
+            except Exception:
+                print(traceback.format_exc())
+
+
+def save_utterance(audio_data, fname, config):
+    audio_data = (
+        audio_data - np.mean(audio_data)
+    ).astype(np.int16)
+    write(
+        os.path.join(
+            config['audio_dir'], f"{fname}.wav"
+        ),
+        config['mic']['rate'],
+        audio_data.astype(np.dtype(config['mic']['format'])),
+    )
+
+# run VAD on a single frame from a device and submit finished (or periodic partial) utterances for transcription
+# finished utterances are written to audio_dir with save, which the asyncio runtime replaces to write off the event loop
+# returns whether the frame was speech so the caller can visualize it on the LED's
+def detect_frame(submit, device, data, config, save=save_utterance):
+    RATE = config['mic']['rate']
+    FRAMES_PER_SECOND = int(RATE / config['mic']['chunk'])
+    MIC_FORMAT = np.dtype(config['mic']['format'])
+
+    frame = np.frombuffer(data, dtype=MIC_FORMAT)
+    is_speech = device.vad.is_speech(data, frame)  # energy-gated, clearly silent frames skip webrtcvad
+
+    device.vad.push(is_speech)  # Running window to calculate ratio of frames that are classified as speech
+
+    if device.vad.full():  # wait till full
+        ratio = device.vad.ratio()
+
+        if not device.vad.recording:
+            # Keep pre-buffering until VAD ratio is enough to indicate speech
+            device.vad.pre_buffer.append(frame)
+            if ratio > config['vad']['start_ratio']:
+                device.vad.fname = f"output_{device.hostname}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+                device.log.debug(
+                    f"🔴 Started recording. VAD window: {device.vad.visualization()}"
+                )
+                device.vad.recording = True
+                device.vad.buffer.extend(device.vad.pre_buffer)
+                device.vad.pre_buffer.clear()
+        else:
+            device.vad.buffer.append(frame)
+            device.vad.frame_count += 1
+            # This is used to transcribe every TRANSCRIBE_PERIOD seconds, in applications where you want to see transcription updating realtime, say on a screen
+            if (
+                device.vad.frame_count
+                % int(FRAMES_PER_SECOND * config['transcribe']['period'])
+                == 0
+            ):
+                audio_data = device.vad.buffer.view()
+                device.log.debug(
+                    f"Adding incomplete phrase to transcribe queue"
+                )
+                submit(audio_data, device, False)
+
+            # Speech has stopped
+            if ratio < config['vad']['silence_stopping_ratio']:
+                device.vad.silence_count += 1
+                if (
+                    device.vad.silence_count
+                    > config['vad']['silence_stopping_time'] * FRAMES_PER_SECOND
+                ):
+                    audio_data = device.vad.buffer.view() # stays valid, vad.reset() below records into a new arena
+                    submit(audio_data, device, True)
+                    save(audio_data, device.vad.fname, config)
+                    device.log.debug(
+                        f"⏹ Added to transcribe queue. Saved to {device.vad.fname}.wav",
+                        extra={"highlighter": None},
+                    )
+                    device.vad.reset()
+            else:
+                device.vad.silence_count = 0
+
+    return is_speech
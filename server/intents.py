@@ -0,0 +1,167 @@
+import re
+import threading
+
+from rich import print
+
+COLORS = {
+    "red": [255, 0, 0],
+    "green": [0, 255, 0],
+    "blue": [0, 0, 255],
+    "yellow": [255, 255, 0],
+    "orange": [255, 165, 0],
+    "purple": [128, 0, 128],
+    "pink": [255, 105, 180],
+    "cyan": [0, 255, 255],
+    "magenta": [255, 0, 255],
+    "white": [255, 255, 255],
+}
+TEMPERATURES = ["warm", "warm white", "cozy", "candle", "neutral", "neutral white", "daylight", "cool", "cool white", "bright white"]
+LIGHT_WORDS = ["light", "lights", "lamp", "lamps"]
+FAN_WORDS = ["fan", "fans"]
+
+FILLER_START = re.compile(r"^(?:(?:hey|ok|okay|please|can you|could you|would you|will you|go ahead and)\s+)+")
+FILLER_END = re.compile(r"(?:\s+(?:please|for me|thanks|thank you|now))+$")
+VALUES = "|".join(sorted(TEMPERATURES + list(COLORS), key=len, reverse=True))
+GRAMMARS = [ # (intent, pattern), first match wins
+    ("query", re.compile(r"^(?:is|are) (?P<target>.+) (?:turned |switched )?(?P<state>on|off)$")),
+    ("power", re.compile(r"^(?:turn|switch|put) (?P<state>on|off) (?P<target>.+)$")),
+    ("power", re.compile(r"^(?:turn|switch|put) (?P<target>.+) (?P<state>on|off)$")),
+    ("brightness", re.compile(r"^(?:set|dim|turn|put|bring|make) (?P<target>.+?) (?:brightness )?(?:to|at) (?P<level>\d{1,3}) percent$")),
+    ("brightness", re.compile(r"^(?:set|dim|turn|change) (?:the )?brightness (?:of|for) (?P<target>.+) to (?P<level>\d{1,3}) percent$")),
+    ("color", re.compile(rf"^(?:turn|make|set|change|switch) (?P<target>.+?) (?:(?:colou?r )?to )?(?P<value>{VALUES})$")),
+]
+
+def normalize(text):
+    text = text.lower().replace("%", " percent")
+    text = re.sub(r"[^a-z0-9 ]+", " ", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    return FILLER_END.sub("", FILLER_START.sub("", text))
+
+def strip_light_word(name):
+    for word in LIGHT_WORDS:
+        if name.endswith(f" {word}"):
+            return name[:-len(word) - 1]
+    return name
+
+class IntentRouter:
+    """Handles simple home commands ("turn off the fan", "set the bedroom light to 30%") without the LLM.
+
+    Targets are resolved with an alias index built from the cached Home Assistant entities (friendly names,
+    entity ids and `intents.aliases` from config.yaml), rebuilt whenever entities are added or removed.
+    route() returns (spoken_response, function_calls) when it's confident, otherwise None and the LLM handles it.
+    """
+    def __init__(self, entities, config):
+        self.entities = entities
+        self.synonyms = config.get('intents', {}).get('aliases') or {} # entity_id -> extra names, e.g. rooms
+        self.lock = threading.Lock()
+        self.aliases = {} # normalized name -> set of entity ids
+        self.lights = []
+        self.fans = []
+        self.rebuild()
+        entities.on_change(self.rebuild)
+
+    def rebuild(self):
+        aliases = {}
+        lights = [s['entity_id'] for s in self.entities.domain('light')]
+        fans = [s['entity_id'] for s in self.entities.domain('switch') if 'fan' in s['entity_id']]
+        for entity_id in lights + fans:
+            names = [entity_id.split('.', 1)[1].replace('_', ' '), self.name(entity_id)] + self.synonyms.get(entity_id, [])
+            for name in names:
+                name = normalize(name)
+                for alias in {name, strip_light_word(name)}:
+                    aliases.setdefault(alias, set()).add(entity_id)
+        with self.lock:
+            self.aliases, self.lights, self.fans = aliases, lights, fans
+        print(f"🧭 Intent router indexed {len(aliases)} names for {len(lights)} lights & {len(fans)} fans")
+
+    def name(self, entity_id):
+        state = self.entities.get(entity_id) or {}
+        return state.get('attributes', {}).get('friendly_name') or entity_id.split('.', 1)[1].replace('_', ' ')
+
+    def resolve(self, target):
+        """Entity ids a spoken target refers to, or None if it's unknown or ambiguous."""
+        everything = re.match(r"^all (?:of )?(?:the )?", target)
+        target = re.sub(r"^(?:all (?:of )?)?(?:the |my )?", "", target)
+        plural = everything or target.endswith("s")
+        with self.lock:
+            aliases, lights, fans = self.aliases, self.lights, self.fans
+        for name in [target, strip_light_word(target)]:
+            ids = aliases.get(name)
+            if ids and (len(ids) == 1 or plural):
+                return sorted(ids)
+        # a leading part of a longer name, e.g. "living room" for "Living Room RGBWW Lights"
+        name = strip_light_word(target)
+        ids = set().union(*[ids for alias, ids in aliases.items() if alias.startswith(f"{name} ")])
+        if ids and (len(ids) == 1 or plural):
+            return sorted(ids)
+        if target in LIGHT_WORDS and lights and (plural or len(lights) == 1):
+            return list(lights)
+        if target in FAN_WORDS and fans and (plural or len(fans) == 1):
+            return list(fans)
+        return None
+
+    def route(self, text):
+        text = normalize(text)
+        for intent, pattern in GRAMMARS:
+            match = pattern.match(text)
+            if match is None:
+                continue
+            ids = self.resolve(match.group('target'))
+            if ids is None:
+                return None
+            routed = getattr(self, intent)(ids, **{k: v for k, v in match.groupdict().items() if k != 'target'})
+            if routed is None:
+                return None
+            spoken_response, function_calls = routed
+            return spoken_response[:1].upper() + spoken_response[1:], function_calls
+        return None
+
+    def describe(self, ids):
+        if len(ids) == 1:
+            return self.name(ids[0])
+        return "Fans" if all(i.startswith('switch.') for i in ids) else "Lights"
+
+    def query(self, ids, state):
+        if len(ids) != 1:
+            return None
+        current = self.entities.state(ids[0])
+        if current not in ("on", "off"):
+            return None
+        answer = "Yes" if current == state else "No"
+        return f"{answer}, it's {current}.", []
+
+    def power(self, ids, state):
+        fans = [i for i in ids if i.startswith('switch.')]
+        lights = [i for i in ids if i.startswith('light.')]
+        calls = [
+            {"name": "control_fan", "arguments": {"entity_id": fan, "state": state}} for fan in fans
+        ]
+        if lights:
+            arguments = {"entity_id": lights}
+            if state == "off":
+                arguments["brightness"] = 0
+            calls.append({"name": "control_light", "arguments": arguments})
+        return f"{self.describe(ids)} turned {state}.", calls
+
+    def brightness(self, ids, level):
+        level = int(level)
+        if level > 100 or not all(i.startswith('light.') for i in ids):
+            return None
+        calls = [{"name": "control_light", "arguments": {"entity_id": ids, "brightness": round(level * 255 / 100)}}]
+        return f"{self.describe(ids)} set to {level} percent.", calls
+
+    def color(self, ids, value):
+        if not all(i.startswith('light.') for i in ids):
+            return None
+        if value in COLORS:
+            calls = [{"name": "control_light", "arguments": {"entity_id": ids, "rgb_color": COLORS[value]}}]
+        else:
+            for entity_id in ids:
+                attributes = (self.entities.get(entity_id) or {}).get('attributes', {})
+                if 'min_color_temp_kelvin' not in attributes and 'max_color_temp_kelvin' not in attributes:
+                    return None # let the LLM explain that it can't
+            calls = [
+                {"name": "control_light_temperature", "arguments": {"entity_id": i, "temperature_description": value}}
+                for i in ids
+            ]
+        return f"Setting {self.describe(ids)} to {value}.", calls
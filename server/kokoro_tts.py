@@ -1,28 +1,55 @@
 import json
 import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
+import numpy as np
 import torch
-from pydub import AudioSegment
 import soundfile as sf
+from concurrent.futures import ThreadPoolExecutor
+from scipy.signal import resample_poly
 from rich import print
-from kokoro import KPipeline
+from kokoro import KModel, KPipeline
+
+SAMPLE_RATE = 24000 # Kokoro output
+DEVICE_RATE = 16000 # ESP32 playback
 
 class KokoroTTS:
     def __init__(self, config):            
         # Load configuration
         self.config = config
         self.jsonfile = config.get('voices_file', 'kokoro_voices.json')
-        self.temp_wav_fname = config.get('temp_wav_fname', 'temp.wav')
+        self.speed = config.get('tts', {}).get('speed', 1.0)
+        self.archive_enabled = config.get('tts', {}).get('archive', False)
+        self.archive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tts-archive")
         self.default_voice = config.get('kokoro_default_voice', 'af_heart')
         self.default_lang = config.get('kokoro_default_lang', 'a')  # 'a' = American English
         
-        # Initialize Kokoro pipeline
-        self.pipeline = KPipeline(lang_code=self.default_lang)
+        self.max_pipelines = max(1, config.get('tts', {}).get('max_pipelines', 2))
+
+        # One model shared by a pipeline per language, pipelines are built on first use and the least recently used
+        # one is dropped when there are more than `tts.max_pipelines`
+        start = time.time()
+        self.model = KModel().to('cuda' if torch.cuda.is_available() else 'cpu').eval()
+        self.load_times = {'model': time.time() - start} # what -> seconds
+        self.pipelines = OrderedDict() # lang_code -> KPipeline
+        self.pipeline_lock = threading.Lock()
+        self.voice_packs = {} # voice_id -> voice embedding, kept when a pipeline is evicted
+        self.voice_lock = threading.Lock()
+        self.get_pipeline(self.default_lang)
         
         # Get available voices
         self.voices = self.get_voices()
         for k, v in self.voices.items():
             print(f"{v['name']} \t[dim]({v['voice_id']})[/dim]")
+
+        # Load voice embeddings up front so nobody's first reply waits for them
+        preload = config.get('tts', {}).get('preload', 'background')
+        if preload == 'background':
+            threading.Thread(target=self.preload, name="tts-preload", daemon=True).start()
+        elif preload:
+            self.preload()
             
     def get_voices(self):
         # For now, we'll create a simple dictionary with default voices
@@ -61,50 +88,132 @@ class KokoroTTS:
                 device.log.warning(f"Voice '{getattr(device, 'voice', None)}' not found, using default {self.default_voice}")
             return self.default_voice
     
-    def text_to_speech(self, device, text, path_name="data"):
-        # Create directory if it doesn't exist
-        os.makedirs(path_name, exist_ok=True)
-        
-        # Get current timestamp for filename
-        now = datetime.now()
-        now_str = now.strftime("%Y-%m-%d_%H-%M-%S")
-        
-        # Get voice ID
-        voice_id = self.get_voice_id(device)
-        
+    def get_lang_code(self, device):
         # Get language code - default to American English
-        lang_code = self.default_lang
         if hasattr(device, 'voice') and device.voice in self.voices:
-            lang_code = self.voices[device.voice].get('lang_code', self.default_lang)
-            
+            return self.voices[device.voice].get('lang_code', self.default_lang)
+        return self.default_lang
+
+    def get_pipeline(self, lang_code):
+        with self.pipeline_lock: # building the same pipeline twice would waste the memory the budget is for
+            pipeline = self.pipelines.get(lang_code)
+            if pipeline is not None:
+                self.pipelines.move_to_end(lang_code)
+                return pipeline
+            start = time.time()
+            pipeline = self.pipelines[lang_code] = KPipeline(lang_code=lang_code, model=self.model)
+            self.load_times[f"pipeline {lang_code}"] = elapsed = time.time() - start
+            print(f"[dim]🗣️  Loaded Kokoro pipeline for lang_code '{lang_code}' in {elapsed:.1f}s[/]")
+            while len(self.pipelines) > self.max_pipelines:
+                evicted, _ = self.pipelines.popitem(last=False)
+                print(f"[dim]🗣️  Unloaded Kokoro pipeline for lang_code '{evicted}'[/]")
+            return pipeline
+
+    def get_voice_pack(self, voice_id, lang_code):
+        with self.voice_lock:
+            pack = self.voice_packs.get(voice_id)
+            if pack is None:
+                start = time.time()
+                # any pipeline can load a voice, don't build (and maybe evict) one just for that
+                with self.pipeline_lock:
+                    pipeline = self.pipelines.get(lang_code) or next(reversed(self.pipelines.values()), None)
+                pack = self.voice_packs[voice_id] = (pipeline or self.get_pipeline(lang_code)).load_voice(voice_id)
+                self.load_times[f"voice {voice_id}"] = time.time() - start
+            return pack
+
+    def preload(self):
+        """Load the embedding of every voice in voices.json, and pipelines for their languages while they fit."""
+        start = time.time()
+        lang_codes = []
+        for voice in self.voices.values():
+            lang_code = voice.get('lang_code', self.default_lang)
+            if lang_code not in lang_codes:
+                lang_codes.append(lang_code)
+        try:
+            # the default language last, so it's the one kept if the others don't fit
+            for lang_code in sorted(lang_codes, key=lambda l: l == self.default_lang)[-self.max_pipelines:]:
+                self.get_pipeline(lang_code)
+            for voice in self.voices.values():
+                self.get_voice_pack(voice['voice_id'], voice.get('lang_code', self.default_lang))
+        except Exception as e:
+            print(f"[orange1]Failed to preload Kokoro voices: {e}[/]")
+            return
+        print(f"🗣️  Preloaded {len(self.voice_packs)} voices in {time.time() - start:.1f}s")
+
+    def segments(self, device, text):
+        """Yields float32 24kHz audio for every segment Kokoro splits the text into, as soon as it's synthesized."""
+        voice_id = self.get_voice_id(device)
+        lang_code = self.get_lang_code(device)
+
         # Log the TTS request
         if hasattr(device, 'log'):
             device.log.debug(f"Generating speech for: '{text[:30]}...' using voice {voice_id}", extra={"highlighter": None})
-        
-        # Generate speech using Kokoro
+
+        pipeline = self.get_pipeline(lang_code)
+        voice = self.get_voice_pack(voice_id, lang_code)
+        for _, _, audio in pipeline(text, voice=voice, speed=self.speed):
+            if isinstance(audio, torch.Tensor):
+                audio = audio.cpu().numpy()
+            yield np.asarray(audio, dtype=np.float32)
+
+    def pcm_segments(self, device, text):
+        """Yields device-ready PCM (16kHz mono int16 bytes) for every segment as soon as it's synthesized."""
+        segments = []
+        for audio in self.segments(device, text):
+            segments.append(audio)
+            yield to_device_pcm(audio)
+        if segments:
+            self.archive(device, np.concatenate(segments))
+
+    def stream(self, device, text):
+        """Same as pcm_segments but logs errors instead of raising them."""
         try:
-            # Create the generator
-            generator = self.pipeline(text, voice=voice_id, speed=1.0)
-            
-            # We'll only use the first generated segment for simplicity
-            # In a more complex implementation, you might want to handle multiple segments
-            for _, (_, _, audio) in enumerate(generator):
-                # Save to wav file
-                output_wav = os.path.join(path_name, f'{voice_id}_{now_str}.wav')
-                sf.write(output_wav, audio, 24000)  # Kokoro uses 24kHz sampling rate
-                
-                # Also save to the temp file location for compatibility
-                temp_wav_path = os.path.join(path_name, self.temp_wav_fname)
-                sf.write(temp_wav_path, audio, 24000)
-                
-                if hasattr(device, 'log'):
-                    device.log.debug(f"Saved audio to {output_wav}", extra={"highlighter": None})
-                
-                return self.temp_wav_fname
+            yield from self.pcm_segments(device, text)
+        except Exception as e:
+            if hasattr(device, 'log'):
+                device.log.error(f"Error generating speech: {str(e)}")
+            else:
+                print(f"[bold red]Error generating speech: {str(e)}[/]")
+
+    def synthesize(self, device, text):
+        """The whole reply as device-ready PCM (16kHz mono int16 bytes), or None if synthesis failed."""
+        try:
+            # Longer replies are split into several segments, keep all of them
+            segments = list(self.segments(device, text))
+            if not segments:
+                return None
+            audio = np.concatenate(segments)
+            self.archive(device, audio)
+            return to_device_pcm(audio)
                 
         except Exception as e:
             if hasattr(device, 'log'):
                 device.log.error(f"Error generating speech: {str(e)}")
             else:
                 print(f"[bold red]Error generating speech: {str(e)}[/]")
-            return None
\ No newline at end of file
+            return None
+
+    def archive(self, device, audio):
+        """Save a reply to `audio_dir` in the background if `tts.archive` is enabled."""
+        if not self.archive_enabled:
+            return
+        fname = os.path.join(self.config['audio_dir'], f'{self.get_voice_id(device)}_{datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")}.wav')
+        def write():
+            try:
+                os.makedirs(self.config['audio_dir'], exist_ok=True)
+                sf.write(fname, audio, SAMPLE_RATE)
+                if hasattr(device, 'log'):
+                    device.log.debug(f"Saved audio to {fname}", extra={"highlighter": None})
+            except Exception as e:
+                print(f"[orange1]Failed to archive speech to {fname}: {e}[/]")
+        self.archive_executor.submit(write)
+
+    def report(self):
+        slowest = sorted(self.load_times.items(), key=lambda item: -item[1])[:5]
+        print(f"[dim]🗣️  Kokoro: {len(self.pipelines)} pipelines loaded {list(self.pipelines)}, {len(self.voice_packs)} voices, "
+              f"slowest loads: {', '.join(f'{what} {seconds:.1f}s' for what, seconds in slowest)}[/]")
+
+def to_device_pcm(audio):
+    """Kokoro's float32 24kHz audio to the device's 16kHz mono int16 PCM bytes (polyphase resampling by 2/3)."""
+    audio = resample_poly(audio, DEVICE_RATE // 8000, SAMPLE_RATE // 8000)
+    return (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
@@ -0,0 +1,65 @@
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from rich import print
+
+class LedDispatcher:
+    """Visualizes speech on the device LED's without doing any device I/O on the audio receive path.
+
+    Ingest pushes VAD results onto a deque (append/popleft are atomic, so producers never take a lock),
+    and a single thread turns them into LED blink commands every `led.update_period`.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.period = config['led']['update_period']
+        self.power = config['led']['power']
+        self.samples = deque() # devices with a speech frame since the last update, one entry per frame
+        # only used for devices without a persistent control channel, so one slow device can't hold up the rest
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="led")
+        # devices with a blink still being sent, new blinks for them are dropped rather than queued behind it
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="leds", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def push(self, device, is_speech):
+        if is_speech: # only speech accumulates power
+            self.samples.append(device)
+
+    def drain(self):
+        power = {}
+        while True:
+            try:
+                device = self.samples.popleft()
+            except IndexError:
+                return power
+            power[device] = min(255, power.get(device, 0) + self.power)  # accumulate power until ready to update LED's
+
+    def run(self):
+        while True:
+            time.sleep(self.period)
+            try:
+                for device, power in self.drain().items():
+                    header = device.led_blink_header(power)
+                    if device.control:
+                        device.control.send(header)
+                    else:
+                        with self.lock:
+                            if device.hostname in self.in_flight:
+                                continue
+                            self.in_flight.add(device.hostname)
+                        self.executor.submit(self.send, device, header)
+            except Exception:
+                print(traceback.format_exc())
+
+    def send(self, device, header):
+        try:
+            device.send_TCP(header, None, 0.1)
+        finally:
+            with self.lock:
+                self.in_flight.discard(device.hostname)
@@ -1,18 +1,61 @@
 import dateparser
 import json
-import os
 import requests
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dateutil import tz
 from rich import print
 
+from context import ContextBudget
+from home_assistant import EntityCache
+from http_client import HTTPClients
+from intents import IntentRouter
+from llm_scheduler import LLMScheduler, FINAL
+from notes import NotesStore
+from response_cache import ResponseCache
+from speculation import Speculator
+
+FUNCTION_UPSTREAMS = { # function name -> upstream it calls, each upstream has its own concurrency limit
+    'add_note': 'notes',
+    'get_notes': 'notes',
+    'search_notes': 'notes',
+    'control_light': 'home_assistant',
+    'control_fan': 'home_assistant',
+    'control_light_temperature': 'home_assistant',
+}
+
 class KoboldCPPConnector:
     def __init__(self, config):
         self.config = config
         self.kobold_url = config.get('kobold', {}).get('url', 'http://localhost:5001/api')
+        self.http = HTTPClients(config)
+        self.scheduler = LLMScheduler(self.http.kobold_slots, config)
+        self.entities = EntityCache(self.http.home_assistant, config)
+        self.notes = NotesStore(config) if config['use_notes'] else None
         self.functions = self.setup_functions()
+        self.functions_version = 0 # bumped when the function schemas change, devices rebuild their system prompt
+        if self.config['use_home_assistant']:
+            self.entities.on_change(self.refresh_functions)
+            self.entities.start()
+        # simple home commands are handled without the LLM
+        self.router = None
+        if self.config['use_home_assistant'] and self.config.get('intents', {}).get('enabled', True):
+            self.router = IntentRouter(self.entities, config)
         self.debug = config.get('kobold', {}).get('debug', False)
+        self.context = ContextBudget(self.http.kobold, config)
+        self.stream = config.get('kobold', {}).get('stream', False)
+        self.cache = ResponseCache(config)
+        self.speculator = Speculator(self, config)
+        self.function_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="functions")
+        # individual calls run on their own pool so execute_functions can wait on them from function_executor
+        self.call_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="function-calls")
+        limits = config.get('functions', {}).get('limits', {})
+        self.function_limits = {
+            upstream: threading.BoundedSemaphore(limits.get(upstream, default))
+            for upstream, default in [('home_assistant', 4), ('notes', 1)]
+        }
         
     def setup_functions(self):
         """Set up available functions based on configuration."""
@@ -22,30 +65,64 @@ class KoboldCPPConnector:
         # Add notes functions if enabled
         if(self.config['use_notes']):
             functions += [
-                # Notes functions as before...
+                {
+                    "name": "add_note",
+                    "description": f"Save a note for {USERS_NAME} to remember later",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "note": {
+                                "type": "string",
+                                "description": "The note to save",
+                            }
+                        },
+                        "required": ["note"],
+                    },
+                },
+                {
+                    "name": "get_notes",
+                    "description": f"Get the notes {USERS_NAME} saved on a specific day",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "day": {
+                                "type": "string",
+                                "description": "The day to get notes from, e.g. 'today', 'yesterday', 'last Monday' or '2024-03-01'",
+                            }
+                        },
+                        "required": ["day"],
+                    },
+                },
+                {
+                    "name": "search_notes",
+                    "description": f"Search all of {USERS_NAME}'s notes for words, when the day they were saved isn't known",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "query": {
+                                "type": "string",
+                                "description": "Words the notes should contain",
+                            }
+                        },
+                        "required": ["query"],
+                    },
+                },
             ]
 
         # Add Home Assistant functions if enabled, with better error handling
         if(self.config['use_home_assistant']):
             try:
-                with open('credentials.json') as json_file:
-                    cred = json.load(json_file)
-                
-                HA_URL = cred['home_assistant_url']
-                HA_TOKEN = cred['home_assistant_token']
+                HA_URL = self.http.credentials.get('home_assistant_url')
 
                 print(f"\n🏡 Attempting to connect to Home Assistant at {HA_URL}")
                 
-                ha_headers = {
-                    "Authorization": f"Bearer {HA_TOKEN}",
-                }
                 device_entity_ids = []
-                url = f"{HA_URL}api/states"
                 
                 # Add timeout and better error handling
                 try:
-                    response = requests.get(url, headers=ha_headers, timeout=5)
-                    states = response.json()
+                    if not self.entities.loaded:
+                        self.entities.load()
+                    states = self.entities.all()
 
                     light_states = [state for state in states if state['entity_id'].startswith('light.')]
 
@@ -163,11 +240,19 @@ class KoboldCPPConnector:
         # Additional functions can be added here
         
         return functions
+
+    def refresh_functions(self):
+        """Rebuild the function schemas from the entity cache when Home Assistant entities are added or removed."""
+        functions = self.setup_functions()
+        if functions != self.functions:
+            self.functions = functions
+            self.functions_version += 1
+            print(f"🏡 Home Assistant entities changed, updated function definitions")
     
     def build_prompt(self, device, user_input):
         """Build the prompt for KoboldCPP with context shifting in mind."""
         # Check if this is the first interaction or if we need to rebuild the prompt
-        if not hasattr(device, 'cached_prompt') or device.cached_prompt is None:
+        if getattr(device, 'cached_prompt', None) is None or device.functions_version != self.functions_version:
             # Build the initial system prompt
             current_time = datetime.now().strftime("%I:%M %p on %A %B %d, %Y")
             
@@ -226,20 +311,29 @@ AI: Fan turned off.
 # Conversation starts now:
 """
             device.cached_prompt = system_prompt
-            device.context_history = ""
+            device.functions_version = self.functions_version
+            if getattr(device, 'context_turns', None) is None:
+                device.context_turns = [] # "User: ...\nAI: ...\n" strings, trimmed whole turns at a time
             
         # Add the new user input to the conversation history
-        conversation = f"{device.context_history}User: {user_input}\nAI: "
+        new_turn = f"User: {user_input}\nAI: "
+
+        # Drop the oldest turns that no longer fit in the context window (counted in real tokens)
+        kept = self.context.fit(device.cached_prompt, device.context_turns, new_turn)
+        if kept < len(device.context_turns):
+            if self.debug:
+                print(f"\n🔍 DEBUG: Trimming {len(device.context_turns) - kept} turns from context")
+            device.context_turns = device.context_turns[len(device.context_turns) - kept:]
+        conversation = "".join(device.context_turns) + new_turn
         
         # Construct the full prompt for KoboldCPP
         full_prompt = device.cached_prompt + conversation
         
-        return full_prompt, conversation
+        return full_prompt, new_turn
     
-    def generate_response(self, device, prompt):
-        """Generate a response from KoboldCPP."""
-        # KoboldCPP API parameters
-        params = {
+    def generation_params(self, prompt):
+        """KoboldCPP API parameters."""
+        return {
             "prompt": prompt,
             "max_context_length": self.config.get('kobold', {}).get('max_context_length', 2048),
             "max_length": self.config.get('kobold', {}).get('max_length', 200),
@@ -248,15 +342,25 @@ AI: Fan turned off.
             "top_k": self.config.get('kobold', {}).get('top_k', 40),
             "rep_pen": self.config.get('kobold', {}).get('rep_pen', 1.1),
             "stop_sequence": ["User:", "\nUser:"],
-            "stream": False  #TODO: Make this a config option
         }
+
+    def generate_response(self, device, prompt, priority=FINAL, **overrides):
+        """Generate a response from KoboldCPP, overrides replace generation parameters (e.g. genkey, max_length)."""
+        params = self.generation_params(prompt)
+        params["stream"] = False
+        params.update(overrides)
         
         try:
             if self.debug:
                 print(f"\n🔍 DEBUG: Sending prompt to KoboldCPP:\n{prompt}")
             
-            # Make the API request to KoboldCPP
-            response = requests.post(f"{self.kobold_url}/v1/generate", json=params)
+            # Make the API request to KoboldCPP, on the slot that most likely has this device's context cached
+            with self.scheduler.slot(device, prompt, priority, params.get("genkey")) as slot:
+                if slot is None:
+                    return "Error: KoboldCPP is busy"
+                response = slot.client.post("/v1/generate", json=params)
+                if slot.active.stopped:
+                    return "Error: Generation was aborted" # the text is cut short, e.g. preempted speculation
             
             if response.status_code != 200:
                 return f"Error: KoboldCPP returned status code {response.status_code}"
@@ -276,6 +380,73 @@ AI: Fan turned off.
             
         except Exception as e:
             return f"Error: Failed to generate response from KoboldCPP: {str(e)}"
+
+    def generate_stream(self, device, prompt):
+        """Generate a response from KoboldCPP's SSE endpoint, yielding tokens as they arrive."""
+        params = self.generation_params(prompt)
+
+        try:
+            if self.debug:
+                print(f"\n🔍 DEBUG: Streaming prompt to KoboldCPP:\n{prompt}")
+
+            with self.scheduler.slot(device, prompt) as slot:
+                if slot is None:
+                    yield "Error: KoboldCPP is busy"
+                    return
+                with slot.client.post("/extra/generate/stream", json=params, stream=True) as response:
+                    if response.status_code != 200:
+                        yield f"Error: KoboldCPP returned status code {response.status_code}"
+                        return
+
+                    # SSE: "event: message" followed by "data: {\"token\": ...}" for every token
+                    for line in response.iter_lines(chunk_size=1, decode_unicode=True):  # tokens are tiny, don't wait for 512 byte chunks
+                        if line and line.startswith('data:'):
+                            yield json.loads(line[len('data:'):]).get('token', '')
+
+        except Exception as e:
+            yield f"Error: Failed to generate response from KoboldCPP: {str(e)}"
+
+    def stream_response(self, device, prompt, on_spoken):
+        """Stream a response, handing the spoken first line to on_spoken as soon as it's complete.
+        Function calls are collected while the rest streams in and executed together in the background,
+        so they're merged and keep their order like in a non-streamed reply."""
+        generated_text = ""
+        handled_lines = 0
+        spoken = False
+        function_calls = []
+
+        def handle(line):
+            nonlocal spoken
+            line = line.strip()
+            if not spoken:
+                if line:
+                    spoken = True
+                    on_spoken(line)
+            else:
+                function_data = self.parse_function_call(line)
+                if function_data is not None:
+                    function_calls.append(function_data)
+
+        for token in self.generate_stream(device, prompt):
+            generated_text += token
+            if 'User:' in generated_text:
+                generated_text = generated_text.split('User:')[0]
+                break
+            lines = generated_text.split('\n')
+            for line in lines[handled_lines:-1]:  # every line but the last is complete
+                handle(line)
+            handled_lines = len(lines) - 1
+
+        for line in generated_text.split('\n')[handled_lines:]:
+            handle(line)
+        if not spoken:
+            on_spoken("")
+        if function_calls:
+            self.execute_functions_background(device, function_calls)
+
+        if self.debug:
+            print(f"\n🔍 DEBUG: KoboldCPP streamed response:\n{generated_text}")
+        return generated_text.strip()
     
     def parse_response(self, text):
         """Parse the generated text into spoken response and function calls."""
@@ -287,65 +458,121 @@ AI: Fan turned off.
         # Look for function calls
         function_calls = []
         for line in lines[1:]:
-            if '<functioncall>' in line:
-                # Extract JSON from the functioncall tag
-                try:
-                    function_str = line.replace('<functioncall>', '').replace('</functioncall>', '').strip()
-                    # Add debug print
-                    print(f"🔍 Found function call: {function_str}")
-                    function_data = json.loads(function_str)
-                    function_calls.append(function_data)
-                except json.JSONDecodeError as e:
-                    print(f"⚠️ Warning: Failed to parse function call: {line}")
-                    print(f"⚠️ Error details: {e}")
+            function_data = self.parse_function_call(line)
+            if function_data is not None:
+                function_calls.append(function_data)
         
         # Add debug print for results
         print(f"🔍 Parsed response: spoken={spoken_response}, functions={function_calls}")
         
         return spoken_response, function_calls
+
+    def parse_function_call(self, line):
+        """Parse a single <functioncall> line, returns None if it isn't a valid function call."""
+        if '<functioncall>' not in line:
+            return None
+        # Extract JSON from the functioncall tag
+        try:
+            function_str = line.replace('<functioncall>', '').replace('</functioncall>', '').strip()
+            # Add debug print
+            print(f"🔍 Found function call: {function_str}")
+            return json.loads(function_str)
+        except json.JSONDecodeError as e:
+            print(f"⚠️ Warning: Failed to parse function call: {line}")
+            print(f"⚠️ Error details: {e}")
+            return None
     
     def execute_functions(self, device, function_calls):
-        """Execute the identified function calls."""
-        results = []
-        
+        """Execute the identified function calls concurrently, limited per upstream, and return results in order."""
+        function_calls = self.merge_function_calls(function_calls)
+        futures = []
+        for function_call in function_calls:
+            # calls touching the same entity keep their order, e.g. turning a light on before changing its colour
+            entities = self.function_entities(function_call)
+            earlier = [f for c, f in zip(function_calls, futures) if entities & self.function_entities(c)]
+            futures.append(self.call_executor.submit(self.call_function, device, function_call, earlier))
+        return [
+            {'function': function_call.get('name'), 'result': future.result()}
+            for function_call, future in zip(function_calls, futures)
+        ]
+
+    def execute_functions_background(self, device, function_calls):
+        """execute_functions on the function executor, for when the spoken reply doesn't wait for the results."""
+        def log_failure(future):
+            if future.exception() is not None:
+                device.log.error(f"Executing functions failed: {future.exception()!r}")
+        self.function_executor.submit(self.execute_functions, device, function_calls).add_done_callback(log_failure)
+
+    def merge_function_calls(self, function_calls):
+        """Merge consecutive Home Assistant calls that only differ by entity into one multi-entity call.
+        Only neighbours are merged, so no call moves ahead of one that came before it."""
+        merged = []
+        last_key = None # (name, other arguments) of the last merged call, None if it can't be merged into
         for function_call in function_calls:
             function_name = function_call.get('name')
             function_args = function_call.get('arguments', {})
-            
-            result = None
-            
-            # Notes functions
-            if function_name == 'add_note':
-                result = self.add_note(device, **function_args)
-            elif function_name == 'get_notes':
-                result = self.get_notes(device, **function_args)
-            
-            # Home Assistant functions
-            elif function_name == 'control_light':
-                result = self.control_light(device, **function_args)
-            elif function_name == 'control_fan':
-                result = self.control_fan(device, **function_args)
-            elif function_name == 'control_light_temperature':
-                result = self.control_light_temperature(device, **function_args)
-            
-            results.append({
-                'function': function_name,
-                'result': result
-            })
+            if FUNCTION_UPSTREAMS.get(function_name) != 'home_assistant' or 'entity_id' not in function_args:
+                merged.append(function_call)
+                last_key = None
+                continue
+            others = {k: v for k, v in function_args.items() if k != 'entity_id'}
+            key = (function_name, json.dumps(others, sort_keys=True))
+            if key != last_key:
+                merged.append({'name': function_name, 'arguments': dict(function_args)})
+                last_key = key
+                continue
+            # HA services accept a list of entities
+            arguments = merged[-1]['arguments']
+            target = arguments['entity_id'] if isinstance(arguments['entity_id'], list) else [arguments['entity_id']]
+            entity_ids = function_args['entity_id'] if isinstance(function_args['entity_id'], list) else [function_args['entity_id']]
+            arguments['entity_id'] = target + [e for e in entity_ids if e not in target]
+        return merged
+
+    def function_entities(self, function_call):
+        entity_ids = function_call.get('arguments', {}).get('entity_id', [])
+        return set(entity_ids if isinstance(entity_ids, list) else [entity_ids])
+
+    def call_function(self, device, function_call, after=()):
+        for future in after:
+            future.exception() # wait, failures are logged by the call itself
+        function_name = function_call.get('name')
+        function_args = function_call.get('arguments', {})
+        upstream = FUNCTION_UPSTREAMS.get(function_name)
+        if upstream is None:
+            device.log.warning(f"Unknown function: {function_name}")
+            return None
+        if upstream == 'notes' and self.notes is None:
+            return "Notes are disabled"
+
+        with self.function_limits[upstream]:
+            try:
+                return self.dispatch_function(device, function_name, function_args)
+            except Exception as e:
+                # e.g. an argument the LLM made up, the spoken reply has already claimed success so at least log it
+                device.log.error(f"Function {function_name} failed: {e!r}")
+                return f"Error: {function_name} failed: {e}"
+
+    def dispatch_function(self, device, function_name, function_args):
+        # Notes functions
+        if function_name == 'add_note':
+            return self.add_note(device, **function_args)
+        elif function_name == 'get_notes':
+            return self.get_notes(device, **function_args)
+        elif function_name == 'search_notes':
+            return self.search_notes(device, **function_args)
+        
+        # Home Assistant functions
+        elif function_name == 'control_light':
+            return self.control_light(device, **function_args)
+        elif function_name == 'control_fan':
+            return self.control_fan(device, **function_args)
+        elif function_name == 'control_light_temperature':
+            return self.control_light_temperature(device, **function_args)
         
-        return results
-            
     def add_note(self, device, note):
-        """Add a note to the notes file."""
-        timestamp = datetime.now().isoformat()
-        note_obj = {
-            'timestamp': timestamp,
-            'note': note
-        }
+        """Add a note to the notes store."""
         try:
-            with open(self.config['notes_file'], 'a') as file:
-                file.write(json.dumps(note_obj))
-                file.write('\n')
+            self.notes.add(note)
             return "Added note successfully"
         except Exception as e:
             device.log.error(f"Error adding note: {e}")
@@ -358,17 +585,8 @@ AI: Fan turned off.
             device.log.error(f'Could not parse date query: {day}')
             return f"Could not parse date query: {day}"
 
-        notes = []
-        if not os.path.exists(self.config['notes_file']):
-            return "No notes file found"
-        
         try:
-            with open(self.config['notes_file'], 'r') as file:
-                for line in file:
-                    note_obj = json.loads(line.strip())
-                    timestamp = datetime.fromisoformat(note_obj['timestamp'])
-                    if timestamp.date() == query_date.date():
-                        notes.append(f"{timestamp.strftime('%I:%M %p')} {note_obj['note']}")
+            notes = [f"{timestamp.strftime('%I:%M %p')} {note}" for timestamp, note in self.notes.day(query_date.date())]
             
             if notes:
                 return f"Found {len(notes)} notes:\n" + '\n'.join(notes)
@@ -376,35 +594,36 @@ AI: Fan turned off.
                 return f"No notes found for {day}"
                 
         except Exception as e:
-            device.log.error(f"Error reading notes file: {e}")
-            return f"Error reading notes file: {str(e)}"
+            device.log.error(f"Error reading notes: {e}")
+            return f"Error reading notes: {str(e)}"
+
+    def search_notes(self, device, query):
+        """Search all notes for words in the query."""
+        try:
+            notes = [f"{timestamp.strftime('%B %d, %Y %I:%M %p')} {note}" for timestamp, note in self.notes.search(query)]
+            if notes:
+                return f"Found {len(notes)} notes:\n" + '\n'.join(notes)
+            else:
+                return f"No notes found matching {query}"
+        except Exception as e:
+            device.log.error(f"Error searching notes: {e}")
+            return f"Error searching notes: {str(e)}"
     
     def control_light(self, device, entity_id, rgb_color=None, brightness=None):
         """Control lights in Home Assistant."""
-        with open("credentials.json", "r") as f:
-            cred = json.load(f)
-        
-        HA_TOKEN = cred.get("home_assistant_token")
-        HA_URL = cred.get("home_assistant_url")
-
         params = {"entity_id": entity_id}
         if rgb_color:
             params['rgb_color'] = rgb_color
         if brightness is not None:
             params['brightness'] = brightness
 
-        url = f"{HA_URL}api/services/light/turn_on"
-        ha_headers = {
-            "Authorization": f"Bearer {HA_TOKEN}",
-            "content-type": "application/json"
-        }
-        
         try:
             device.log.info(f"Light control request:\n{params}")
-            response = requests.post(url, headers=ha_headers, json=params)
+            response = self.http.home_assistant.post("api/services/light/turn_on", json=params)
             
             if response.status_code == 200:
                 device.log.info(f"Light control success")
+                self.entities.apply(response.json())  # HA returns the states that changed
                 return "Success"
             else:
                 device.log.error(f"Light control error: {response.status_code} {response.text}")
@@ -415,29 +634,18 @@ AI: Fan turned off.
     
     def control_fan(self, device, entity_id, state):
         """Control fan switches in Home Assistant."""
-        with open("credentials.json", "r") as f:
-            cred = json.load(f)
-        
-        HA_TOKEN = cred.get("home_assistant_token")
-        HA_URL = cred.get("home_assistant_url")
-
         # Determine the service to call based on the state
         service = "turn_on" if state == "on" else "turn_off"
         
-        url = f"{HA_URL}api/services/switch/{service}"
-        ha_headers = {
-            "Authorization": f"Bearer {HA_TOKEN}",
-            "content-type": "application/json"
-        }
-        
         params = {"entity_id": entity_id}
         
         try:
             device.log.info(f"Fan control request: {entity_id} -> {state}")
-            response = requests.post(url, headers=ha_headers, json=params)
+            response = self.http.home_assistant.post(f"api/services/switch/{service}", json=params)
             
             if response.status_code == 200:
                 device.log.info(f"Fan control success")
+                self.entities.apply(response.json())  # HA returns the states that changed
                 return "Success"
             else:
                 device.log.error(f"Fan control error: {response.status_code} {response.text}")
@@ -448,12 +656,6 @@ AI: Fan turned off.
     
     def control_light_temperature(self, device, entity_id, temperature_description):
         """Control light color temperature based on description (warm/cool/etc)."""
-        with open("credentials.json", "r") as f:
-            cred = json.load(f)
-        
-        HA_TOKEN = cred.get("home_assistant_token")
-        HA_URL = cred.get("home_assistant_url")
-
         # Map common temperature descriptions to Kelvin values
         # Standard ranges:
         # Warm white: 2700-3000K
@@ -475,12 +677,6 @@ AI: Fan turned off.
         # Default to neutral if description not found
         kelvin_value = temperature_map.get(temperature_description.lower(), 4000)
         
-        url = f"{HA_URL}api/services/light/turn_on"
-        ha_headers = {
-            "Authorization": f"Bearer {HA_TOKEN}",
-            "content-type": "application/json"
-        }
-        
         params = {
             "entity_id": entity_id,
             "kelvin": kelvin_value  # Use the kelvin parameter for Home Assistant
@@ -488,10 +684,11 @@ AI: Fan turned off.
         
         try:
             device.log.info(f"Light temperature control request: {entity_id} -> {temperature_description} ({kelvin_value}K)")
-            response = requests.post(url, headers=ha_headers, json=params)
+            response = self.http.home_assistant.post("api/services/light/turn_on", json=params)
             
             if response.status_code == 200:
                 device.log.info(f"Light temperature control success")
+                self.entities.apply(response.json())  # HA returns the states that changed
                 return "Success"
             else:
                 device.log.error(f"Light temperature control error: {response.status_code} {response.text}")
@@ -500,39 +697,99 @@ AI: Fan turned off.
             device.log.error(f"Error controlling light temperature: {e}")
             return f"Error controlling light temperature: {str(e)}"
 
-    def ask_kobold(self, device, user_input):
-        """Main function to get a response from KoboldCPP."""
+    def route(self, device, user_input, on_spoken=None):
+        """Answer simple home commands with the intent router, returns the spoken response or None if the LLM is needed."""
+        if self.router is None:
+            return None
+        routed = self.router.route(user_input)
+        if routed is None:
+            return None
+
+        self.speculator.cancel(device)
+        spoken_response, function_calls = routed
+        full_response = spoken_response
+        for fc in function_calls:
+            full_response += f"\n<functioncall> {json.dumps(fc)}"
+        device.log.info(f"🧭 Routed without LLM: {full_response}")
+
+        if on_spoken is not None:
+            self.execute_functions_background(device, function_calls)
+            on_spoken(spoken_response)
+        else:
+            self.execute_functions(device, function_calls)
+
+        # keep the LLM's view of the conversation complete
+        if getattr(device, 'context_turns', None) is None:
+            device.context_turns = []
+        device.context_turns.append(f"User: {user_input}\nAI: {full_response}\n")
+        device.add_message({"role": "user", "content": user_input})
+        device.add_message({"role": "assistant", "content": full_response})
+        return spoken_response
+
+    def speculate(self, device, partial_text):
+        """Warm up KoboldCPP with a partial transcription, see Speculator."""
+        if not self.speculator.enabled:
+            return
+        if self.router is not None and self.router.route(partial_text) is not None:
+            return # will most likely be handled without the LLM
+        self.speculator.start(device, partial_text)
+
+    def ask_kobold(self, device, user_input, on_spoken=None):
+        """Main function to get a response from KoboldCPP.
+
+        If on_spoken is given it's called once with the spoken response, when streaming this happens as soon as
+        the first line is generated while function calls are still being generated and executed.
+        """
+        # Check for a memoized response before the context changes
+        cache_key = self.cache.key(device, user_input, self.functions_version)
+        cached = self.cache.get(cache_key) if cache_key else None
+
         # Build the prompt
-        full_prompt, conversation_part = self.build_prompt(device, user_input)
-        
-        # Generate response from KoboldCPP
-        generated_text = self.generate_response(device, full_prompt)
+        full_prompt, new_turn = self.build_prompt(device, user_input)
+
+        speculated = None
+        if cached is not None:
+            self.speculator.cancel(device)
+        else:
+            speculated = self.speculator.take(device, full_prompt)
         
-        # Update the context history for next interaction
-        device.context_history = conversation_part + generated_text + "\n"
+        streaming = self.stream and on_spoken is not None and cached is None and speculated is None
+        if cached is not None:
+            generated_text, spoken_response, function_calls = cached
+            device.log.info(f"🗃️ Cached response: {spoken_response}")
+        elif speculated is not None:
+            generated_text = speculated
+        elif streaming:
+            generated_text = self.stream_response(device, full_prompt, on_spoken)
+        else:
+            # Generate response from KoboldCPP
+            generated_text = self.generate_response(device, full_prompt)
         
-        # Make sure we don't exceed the context window
-        max_context_history = self.config.get('kobold', {}).get('max_history_tokens', 1000)
-        if len(device.context_history) > max_context_history:
-            # Simple token estimation (not accurate but good enough)
-            tokens = device.context_history.split()
-            if len(tokens) > max_context_history:
-                # Trim to approximately keep the most recent conversation
-                device.context_history = " ".join(tokens[-max_context_history:])
+        # Update the context history for next interaction, trimmed to the token budget when building the next prompt
+        device.context_turns.append(new_turn + generated_text + "\n")
         
-        # Parse the response
-        spoken_response, function_calls = self.parse_response(generated_text)
+        if cached is None:
+            # Parse the response
+            spoken_response, function_calls = self.parse_response(generated_text)
+            if cache_key:
+                self.cache.put(cache_key, generated_text, spoken_response, function_calls)
         
         # Combine spoken response with function calls in the same format as LLM output
         full_response = spoken_response
         for fc in function_calls:
             full_response += f"\n<functioncall> {json.dumps(fc)}"
 
-        # Execute any function calls
-        function_results = self.execute_functions(device, function_calls)
+        if not streaming:
+            # Execute any function calls (already running in the background when streaming)
+            if on_spoken is not None:
+                # run them while the spoken line is synthesized rather than before
+                self.execute_functions_background(device, function_calls)
+                on_spoken(spoken_response)
+            else:
+                function_results = self.execute_functions(device, function_calls)
         
         # Add to message history (for compatibility with existing code)
         device.add_message({"role": "user", "content": user_input})
         device.add_message({"role": "assistant", "content": full_response})
         
-        return spoken_response
\ No newline at end of file
+        return spoken_response
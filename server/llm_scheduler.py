@@ -0,0 +1,183 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from rich import print
+
+FINAL = 0
+SPECULATIVE = 1
+
+class LLMRequest:
+    def __init__(self, device, prompt, priority, genkey):
+        self.device = device
+        self.prompt = prompt
+        self.priority = priority
+        self.genkey = genkey
+        self.slot = None
+        self.cancelled = False
+        self.stopped = False # aborted while generating, KoboldCPP returns whatever was generated so far
+        self.enqueued = time.time()
+
+class Slot:
+    """One generation slot on a KoboldCPP instance, remembers the last prompt it processed."""
+    def __init__(self, index, client):
+        self.index = index
+        self.client = client
+        self.active = None # LLMRequest being generated
+        self.last_prompt = ""
+        self.requests = 0
+
+class LLMScheduler:
+    """Queues LLM requests and hands them to KoboldCPP slots (`kobold.urls`, repeat a URL for multi-slot servers).
+
+    A request goes to the free slot whose last prompt shares the longest prefix with it, which keeps each device
+    on the slot that already holds its context. Final requests go before speculative ones and preempt speculative
+    generations when every slot is busy. Speculative requests are dropped while final requests are waiting or
+    generating on every slot, and requests beyond `kobold.scheduler.max_queue` are rejected.
+    """
+    def __init__(self, clients, config):
+        settings = config.get('kobold', {}).get('scheduler', {})
+        self.max_queue = settings.get('max_queue', 8)
+        self.report_every = settings.get('report_every', 50)
+        self.slots = [Slot(i, client) for i, client in enumerate(clients)]
+        self.queue = [] # heap of (priority, sequence, LLMRequest)
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.aborted = set() # genkeys aborted before their request reached the scheduler
+
+        self.requests = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_depth = 0
+        self.prefix_chars = 0
+        self.prompt_chars = 0
+        self.prefix_hits = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.preempted = 0
+
+    @contextmanager
+    def slot(self, device, prompt, priority=FINAL, genkey=None):
+        """Waits for a slot and yields it, or yields None if the request was dropped, rejected or aborted.
+        While held, `slot.active` is the request, check its `stopped` flag before trusting the response."""
+        slot = self.acquire(device, prompt, priority, genkey)
+        try:
+            yield slot
+        finally:
+            if slot is not None:
+                self.release(slot)
+
+    def acquire(self, device, prompt, priority, genkey):
+        request = LLMRequest(device, prompt, priority, genkey)
+        preempt = []
+        with self.cond:
+            if genkey in self.aborted:
+                self.aborted.discard(genkey)
+                return None
+            busy = all(slot.active is not None and slot.active.priority == FINAL for slot in self.slots)
+            if priority == SPECULATIVE and (busy or any(r.priority == FINAL for _, _, r in self.queue)):
+                self.dropped += 1
+                return None
+            if len(self.queue) >= self.max_queue:
+                self.rejected += 1
+                device.log.warning(f"LLM queue full ({len(self.queue)} waiting), dropping request")
+                return None
+            heapq.heappush(self.queue, (priority, next(self.sequence), request))
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.dispatch()
+            if request.slot is None and priority == FINAL:
+                preempt = [slot.active for slot in self.slots if slot.active.priority == SPECULATIVE][:1]
+                self.preempted += len(preempt)
+        for active in preempt:
+            self.stop(active)
+
+        with self.cond:
+            while request.slot is None and not request.cancelled:
+                self.cond.wait()
+        return request.slot
+
+    def dispatch(self):
+        # called with self.cond held
+        while self.queue:
+            free = [slot for slot in self.slots if slot.active is None]
+            if not free:
+                return
+            _, _, request = heapq.heappop(self.queue)
+            prefixes = [len(os.path.commonprefix([slot.last_prompt, request.prompt])) for slot in free]
+            best = max(range(len(free)), key=lambda i: prefixes[i])
+            slot = free[best]
+            slot.active = request
+            slot.last_prompt = request.prompt
+            slot.requests += 1
+            request.slot = slot
+            self.record(request, prefixes[best])
+            self.cond.notify_all()
+
+    def release(self, slot):
+        with self.cond:
+            slot.active = None
+            self.dispatch()
+
+    def abort(self, genkey):
+        """Stop a request by genkey, whether it's still queued or already generating."""
+        with self.cond:
+            for i, (_, _, request) in enumerate(self.queue):
+                if request.genkey == genkey:
+                    request.cancelled = True
+                    self.queue.pop(i)
+                    heapq.heapify(self.queue)
+                    self.cond.notify_all()
+                    return
+            active = next((slot.active for slot in self.slots if slot.active and slot.active.genkey == genkey), None)
+            if active is None:
+                self.aborted.add(genkey)
+        if active is not None:
+            self.stop(active)
+
+    def stop(self, request):
+        if request.genkey is None:
+            return
+        request.stopped = True
+        try:
+            request.slot.client.post("/extra/abort", json={"genkey": request.genkey}, timeout=2)
+        except Exception as e:
+            print(f"[orange1]Failed to abort generation on slot {request.slot.index}: {e}[/]")
+
+    def record(self, request, prefix):
+        # called with self.cond held
+        wait = time.time() - request.enqueued
+        self.requests += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.prefix_chars += prefix
+        self.prompt_chars += len(request.prompt)
+        if prefix >= len(request.prompt) // 2:
+            self.prefix_hits += 1
+        if self.report_every and self.requests % self.report_every == 0:
+            self.report()
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'queue_depth': len(self.queue),
+            'max_queue_depth': self.max_depth,
+            'mean_wait_ms': 1000 * self.total_wait / self.requests if self.requests else 0.0,
+            'max_wait_ms': 1000 * self.max_wait,
+            'prefix_hit_rate': self.prefix_hits / self.requests if self.requests else 0.0,
+            'prefix_reuse': self.prefix_chars / self.prompt_chars if self.prompt_chars else 0.0,
+            'dropped_speculative': self.dropped,
+            'rejected': self.rejected,
+            'preempted': self.preempted,
+            'slot_requests': [slot.requests for slot in self.slots],
+        }
+
+    def report(self):
+        stats = self.stats()
+        if stats['requests']:
+            print(f"[dim]🧮 LLM scheduler: {stats['requests']} requests over {len(self.slots)} slots {stats['slot_requests']}, "
+                  f"mean wait {stats['mean_wait_ms']:.0f}ms (max {stats['max_wait_ms']:.0f}ms), max queue {stats['max_queue_depth']}, "
+                  f"prefix hits {100 * stats['prefix_hit_rate']:.0f}% ({100 * stats['prefix_reuse']:.0f}% of prompt reused), "
+                  f"{stats['preempted']} preempted, {stats['dropped_speculative']} speculative dropped, {stats['rejected']} rejected[/]")
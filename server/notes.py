@@ -0,0 +1,98 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+from rich import print
+
+class NotesStore:
+    """SQLite notes storage, indexed by timestamp with optional FTS5 full-text search over note bodies.
+
+    Lookups by day or range use the timestamp index so they stay fast however many notes pile up.
+    Notes from the old JSONL `notes_file` are imported once on first use.
+    """
+    def __init__(self, config):
+        self.path = config.get('notes_db') or os.path.splitext(config['notes_file'])[0] + ".db"
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS notes (id INTEGER PRIMARY KEY, timestamp TEXT NOT NULL, note TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS notes_timestamp ON notes (timestamp);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        self.fts = self.setup_fts()
+        self.migrate(config['notes_file'])
+
+    def setup_fts(self):
+        try:
+            self.db.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(note, content='notes', content_rowid='id');
+                CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+                    INSERT INTO notes_fts (rowid, note) VALUES (new.id, new.note);
+                END;
+            """)
+            return True
+        except sqlite3.OperationalError:
+            print("[orange1]SQLite was built without FTS5, searching notes with LIKE[/]")
+            return False
+
+    def migrate(self, notes_file):
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone() or not os.path.exists(notes_file):
+                return
+            rows = []
+            skipped = 0
+            with open(notes_file, 'r') as file:
+                for number, line in enumerate(file, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        note_obj = json.loads(line)
+                        rows.append((datetime.fromisoformat(note_obj['timestamp']).isoformat(), note_obj['note']))
+                    except (ValueError, KeyError, TypeError) as e:
+                        skipped += 1
+                        print(f"[orange1]Skipping unreadable note on line {number} of {notes_file}: {e!r}[/]")
+            with self.db:
+                self.db.executemany("INSERT INTO notes (timestamp, note) VALUES (?, ?)", rows)
+                self.db.execute("INSERT INTO meta (key, value) VALUES ('migrated', ?)", (notes_file,))
+        print(f"📝 Imported {len(rows)} notes from {notes_file} into {self.path}" + (f", skipped {skipped}" if skipped else ""))
+
+    def add(self, note, timestamp=None):
+        timestamp = (timestamp or datetime.now()).isoformat()
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO notes (timestamp, note) VALUES (?, ?)", (timestamp, note))
+
+    def range(self, start, end):
+        """Notes with start <= timestamp < end as (datetime, note) tuples, oldest first."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT timestamp, note FROM notes WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp",
+                (start.isoformat(), end.isoformat()),
+            ).fetchall()
+        return [(datetime.fromisoformat(timestamp), note) for timestamp, note in rows]
+
+    def day(self, date):
+        start = datetime.combine(date, datetime.min.time())
+        return self.range(start, start + timedelta(days=1))
+
+    def search(self, query, limit=10):
+        """Notes matching all words of the query, most recent first."""
+        words = query.split()
+        if not words:
+            return []
+        with self.lock:
+            if self.fts:
+                match = " ".join('"' + word.replace('"', '""') + '"' for word in words)
+                rows = self.db.execute(
+                    "SELECT notes.timestamp, notes.note FROM notes_fts JOIN notes ON notes.id = notes_fts.rowid "
+                    "WHERE notes_fts MATCH ? ORDER BY notes.timestamp DESC LIMIT ?",
+                    (match, limit),
+                ).fetchall()
+            else:
+                rows = self.db.execute(
+                    "SELECT timestamp, note FROM notes WHERE " + " AND ".join(["note LIKE ?"] * len(words))
+                    + " ORDER BY timestamp DESC LIMIT ?",
+                    [f"%{word}%" for word in words] + [limit],
+                ).fetchall()
+        return [(datetime.fromisoformat(timestamp), note) for timestamp, note in rows]
@@ -0,0 +1,54 @@
+import threading
+import traceback
+from collections import deque
+from queue import Queue
+
+from rich import print
+
+class PipelinePool:
+    """Pool of pipeline workers, different devices are handled in parallel while each device's utterances stay in order.
+
+    A device is handed to at most one worker at a time; after each utterance it goes to the back of the ready
+    queue so a device with a backlog can't starve the others.
+    """
+    def __init__(self, responder, config):
+        self.responder = responder
+        self.config = config
+        self.num_workers = config.get('pipeline', {}).get('workers', 4)
+        self.pending = {} # hostname -> deque of utterances, present while the device has queued or in-flight work
+        self.ready = Queue() # hostnames with pending work that no worker currently owns
+        self.lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self.run, name=f"pipeline-{i}", daemon=True)
+            for i in range(self.num_workers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        print(f"\n🧵 Started {self.num_workers} pipeline workers")
+
+    def put(self, item):
+        data, device, last_one = item
+        with self.lock:
+            utterances = self.pending.get(device.hostname)
+            if utterances is None:
+                self.pending[device.hostname] = deque([item])
+                self.ready.put(device.hostname)
+            else:
+                utterances.append(item)
+
+    def run(self):
+        while True:
+            hostname = self.ready.get()
+            with self.lock:
+                data, device, last_one = self.pending[hostname].popleft()
+            try:
+                self.responder.respond(data, device, last_one)
+            except Exception:
+                print(traceback.format_exc())
+            with self.lock:
+                if self.pending[hostname]:
+                    self.ready.put(hostname)
+                else:
+                    del self.pending[hostname]
@@ -0,0 +1,159 @@
+import threading
+import time
+from queue import Queue
+
+import numpy as np
+
+from asr import load_asr_backend
+from streaming_asr import IncrementalTranscription
+
+class Responder:
+    """Transcribes queued utterances, gets the LLM response and sends TTS back to the device.
+
+    Each stage is a separate method so the threaded and asyncio runtimes can schedule them differently.
+    """
+    def __init__(self, tts, llm, config):
+        self.tts = tts
+        self.llm = llm
+        self.config = config
+        # per-stage concurrency limits, shared by all pipeline workers
+        limits = config.get('pipeline', {}).get('limits', {})
+        self.limits = {
+            stage: threading.BoundedSemaphore(limits.get(stage, default))
+            for stage, default in [('asr', 1), ('llm', 1), ('tts', 1), ('send', 4)]
+        }
+        # when batching, enough workers need to reach the ASR stage at once to fill a batch
+        batch = config['transcribe'].get('batch', {})
+        self.asr_concurrency = batch.get('max_size', 8) if batch.get('enabled', False) else limits.get('asr', 1)
+        self.limits['asr'] = threading.BoundedSemaphore(self.asr_concurrency)
+
+        # commit stable prefixes of in-progress utterances so partial & final transcriptions only decode the new tail
+        self.incremental = config['transcribe'].get('incremental', False)
+        self.streams = {} # hostname -> IncrementalTranscription
+
+        # send each TTS segment as soon as it's synthesized rather than waiting for the whole reply
+        self.stream_tts = config.get('tts', {}).get('stream', True)
+
+        self.asr = load_asr_backend(config)
+
+    def transcribe(self, data, device, last_one=True):
+        if not self.incremental:
+            return self.decode(data, device.last_response)
+
+        stream = self.streams.get(device.hostname)
+        if stream is None:
+            stream = self.streams[device.hostname] = IncrementalTranscription(
+                self.config['mic']['rate'],
+                no_speech_prob=self.config['transcribe']['no_speech_prob'],
+                min_tail=self.config['transcribe'].get('min_tail', 0.3),
+            )
+        if last_one:
+            return stream.finish(self.decode, data, device.last_response)
+        return stream.update(self.decode, data, device.last_response)
+
+    def decode(self, data, initial_prompt=None):
+        with self.limits['asr']:
+            return self.asr.transcribe(
+                data.astype(np.float32) / 32768.0, initial_prompt=initial_prompt
+            )
+
+    def accept(self, res, device, last_one, tic):
+        # returns the transcribed text if it is likely speech, otherwise None
+        if "text" not in res:
+            device.log.warning("No text")
+            return None
+        if not res["segments"]:
+            device.log.debug(f"No result")
+            return None
+
+        device.log.debug(f"Transcription time: {time.time()-tic:.3f}")
+        if res["segments"][0]["no_speech_prob"] >= self.config['transcribe']['no_speech_prob']:
+            device.log.debug(
+                f"[NO SPEECH] {res['text'].strip()} ({res['segments'][0]['no_speech_prob']:.2f})"
+            )
+            return None
+
+        new_res = res["text"].strip()
+        device.log.info(
+            f"[dim]Transcribed:[/] {new_res} ({res['segments'][0]['no_speech_prob']:.2f})"
+            + ("" if last_one else "[INCOMPLETE]")
+        )
+        return new_res
+
+    def think(self, device, text, on_spoken=None):
+        text_response = self.llm.route(device, text, on_spoken)  # doesn't need an LLM slot
+        if text_response is None:
+            with self.limits['llm']:
+                text_response = self.llm.ask_kobold(device, text, on_spoken)
+        device.last_response = text_response  # use this as prompt for next Whisper transcription
+        return text_response
+
+    def speak(self, device, text_response):
+        with self.limits['tts']:
+            return self.tts.synthesize(device, text_response)
+
+    def send(self, device, pcm):
+        with self.limits['send']:
+            device.send_pcm(pcm, mic_timeout=10)
+
+    def speak_stream(self, device, text_response):
+        # the TTS limit only covers synthesizing each segment, not waiting on the device
+        segments = self.tts.stream(device, text_response)
+        while True:
+            with self.limits['tts']:
+                chunk = next(segments, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def speech_chunks(self, device, text_response):
+        """PCM chunks of the reply, synthesized ahead in a background thread so the next segment is ready
+        while the current one is still being sent."""
+        chunks = Queue()
+        def synthesize():
+            try:
+                for chunk in self.speak_stream(device, text_response):
+                    chunks.put(chunk)
+            finally:
+                chunks.put(None)
+        threading.Thread(target=synthesize, name=f"tts-{device.hostname}", daemon=True).start()
+        return iter(chunks.get, None)
+
+    def say(self, device, text_response):
+        if self.stream_tts:
+            with self.limits['send']:
+                sent = device.send_audio_stream(self.speech_chunks(device, text_response), mic_timeout=10)
+            if not sent:
+                device.log.warning(f"No audio sent")
+            return
+
+        pcm = self.speak(device, text_response)
+        if pcm:
+            self.send(device, pcm)
+        else:
+            # TODO: send placeholder response saying there's an issue
+            device.log.warning(f"No audio sent")
+
+    def respond(self, data, device, last_one):
+        tic = time.time()
+        res = self.transcribe(data, device, last_one)
+        new_res = self.accept(res, device, last_one, tic)
+        if new_res is None:
+            return
+        if not last_one:
+            self.llm.speculate(device, new_res)  # get KoboldCPP going while the user is still talking
+            return
+
+        device.stop_listening()  # while server is "thinking"
+
+        # the spoken line is voiced in parallel, when streaming this starts before the LLM has finished
+        speaking = []
+        def on_spoken(text_response):
+            thread = threading.Thread(target=self.say, args=(device, text_response), daemon=True)
+            thread.start()
+            speaking.append(thread)
+
+        self.think(device, new_res, on_spoken)
+        for thread in speaking:
+            thread.join()
+        device.prune_messages()
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from rich import print
+
+from intents import normalize
+
+# answers to these depend on the clock, home state or stored notes, so they're never served from cache
+VOLATILE = re.compile(
+    r"\b(?:time|date|day|today|tonight|tomorrow|yesterday|now|morning|evening|week|month|year|weather|"
+    r"is|are|status|state|note|notes|remember|remind|last|latest|new|messages?)\b"
+)
+
+class ResponseCache:
+    """Memoizes LLM responses for repeated utterances, enabled with `kobold.cache.enabled`.
+
+    Entries are keyed on the normalized transcript plus a fingerprint of the device, the function definitions
+    and the last `context_turns` turns, and expire after `ttl` seconds or when the oldest of `max_entries` is evicted.
+    Parsed function calls are stored with the reply so a hit replays the same actions.
+    """
+    def __init__(self, config):
+        settings = config.get('kobold', {}).get('cache', {})
+        self.enabled = settings.get('enabled', False)
+        self.ttl = settings.get('ttl', 600)
+        self.max_entries = settings.get('max_entries', 256)
+        self.context_turns = settings.get('context_turns', 1)
+        self.entries = OrderedDict() # key -> (expires, generated_text, spoken_response, function_calls)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    def key(self, device, user_input, functions_version):
+        """Cache key for a request, or None if it shouldn't be cached."""
+        if not self.enabled:
+            return None
+        text = normalize(user_input)
+        if not text or VOLATILE.search(text):
+            with self.lock:
+                self.skipped += 1
+            return None
+        turns = getattr(device, 'context_turns', None) or []
+        recent = turns[len(turns) - self.context_turns:] if self.context_turns else []
+        fingerprint = json.dumps([device.hostname, functions_version, recent, text])
+        return hashlib.sha1(fingerprint.encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1:]
+
+    def put(self, key, generated_text, spoken_response, function_calls):
+        if generated_text.startswith("Error:") or not spoken_response:
+            return
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, generated_text, spoken_response, function_calls)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'skipped': self.skipped,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+            }
+
+    def report(self):
+        if self.enabled:
+            stats = self.stats()
+            print(f"[dim]🗃️ LLM response cache: {stats['hits']} hits, {stats['misses']} misses ({100 * stats['hit_rate']:.0f}%), "
+                  f"{stats['skipped']} skipped, {stats['entries']} entries[/]")
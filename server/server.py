@@ -1,4 +1,5 @@
 #file: server.py
+import asyncio
 import atexit
 import json
 import os
@@ -8,169 +9,39 @@ import subprocess
 import threading
 import time
 import traceback
-import warnings
 import yaml
-from datetime import datetime
 from queue import Queue
 
 import numpy as np
 import fire
-import whisper
-from scipy.io.wavfile import write
 from rich import print
 from rich.traceback import install
 
 install(show_locals=False)
 
 from devices import DeviceManager
+from ingest import FrameIngest, detect_frame
 from kokoro_tts import KokoroTTS
+from tts_cache import TTSCache
+from leds import LedDispatcher
 from llm import KoboldCPPConnector # Import the new KoboldFunctionCalling class instead of LMStudioFunctionCalling
+from pipeline import PipelinePool
+from responder import Responder
 
 # listen to UDP packets from devices & use Voice Activity Detection (VAD) to add spoken segments to transcribe queue
-def listen_detect(queue, manager, config):
-
-    UDP_ADDR_PORT = (config['udp']['ip'], config['udp']['port'])
-    CHUNK_BYTES = config['mic']['chunk'] * np.dtype(config['mic']['format']).itemsize
-    RATE = config['mic']['rate']
-    FRAMES_PER_SECOND = int(RATE / config['mic']['chunk'])
-    MIC_FORMAT = np.dtype(config['mic']['format'])
-    
-    while True:
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                s.bind(UDP_ADDR_PORT)
-                while True:
-                    data, addr = s.recvfrom(CHUNK_BYTES)
-                    device = manager.get_device_from_ip(
-                        addr[0]
-                    )  # what device sent this packet? (Needs to be added from multicast_listen)
-                    
-                    if device:
-                        frame = np.frombuffer(data, dtype=MIC_FORMAT)
-                        is_speech = device.vad.vad.is_speech(data, RATE)
-
-                        device.update_LEDs(is_speech)  # Visualize speaking (and server listening) on LED's
-                        device.vad.window.append(is_speech)  # Running window to calculate ratio of frames that are classified as speech
-
-                        if (len(device.vad.window) == device.vad.window.maxlen):  # wait till full
-                            ratio = sum(device.vad.window) / len(device.vad.window)
-
-                            if not device.vad.recording:
-                                # Keep pre-buffering until VAD ratio is enough to indicate speech
-                                device.vad.pre_buffer.append(frame)
-                                if ratio > config['vad']['start_ratio']:
-                                    device.vad.fname = f"output_{device.hostname}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
-                                    device.log.debug(
-                                        f"🔴 Started recording. VAD window: {device.vad.visualization()}"
-                                    )
-                                    device.vad.recording = True
-                                    device.vad.buffer.extend(device.vad.pre_buffer)
-                                    device.vad.pre_buffer.clear()
-                            else:
-                                device.vad.buffer.extend(frame)
-                                device.vad.frame_count += 1
-                                # This is used to transcribe every TRANSCRIBE_PERIOD seconds, in applications where you want to see transcription updating realtime, say on a screen
-                                if (
-                                    device.vad.frame_count
-                                    % int(FRAMES_PER_SECOND * config['transcribe']['period'])
-                                    == 0
-                                ):
-                                    audio_data = np.frombuffer(
-                                        b"".join(list(device.vad.buffer)),
-                                        dtype=MIC_FORMAT,
-                                    )
-                                    device.log.debug(
-                                        f"Adding incomplete phrase to transcribe queue"
-                                    )
-                                    queue.put([audio_data, device, False])
-
-                                # Speech has stopped
-                                if ratio < config['vad']['silence_stopping_ratio']:
-                                    device.vad.silence_count += 1
-                                    if (
-                                        device.vad.silence_count
-                                        > config['vad']['silence_stopping_time'] * FRAMES_PER_SECOND
-                                    ):
-                                        audio_data = np.frombuffer(
-                                            b"".join(list(device.vad.buffer)),
-                                            dtype=MIC_FORMAT,
-                                        )
-                                        queue.put([audio_data, device, True])
-                                        audio_data = (
-                                            audio_data - np.mean(audio_data)
-                                        ).astype(np.int16)
-                                        write(
-                                            os.path.join(
-                                                config['audio_dir'], f"{device.vad.fname}.wav"
-                                            ),
-                                            RATE,
-                                            audio_data.astype(MIC_FORMAT),
-                                        )
-                                        device.log.debug(
-                                            f"⏹ Added to transcribe queue. Saved to {device.vad.fname}.wav",
-                                            extra={"highlighter": None},
-                                        )
-                                        device.vad.reset()
-                                else:
-                                    device.vad.silence_count = 0
-        except Exception:
-            print(traceback.format_exc())
-        finally:
-            if s:
-                s.close()
+def listen_detect(queue, manager, leds, config):
+    submit = lambda data, device, last_one: queue.put([data, device, last_one])
+    ingest = FrameIngest(manager, lambda device, data: leds.push(device, detect_frame(submit, device, data, config)), config)
+    ingest.serve_forever()
 
 
 # transcribe audio segments from queue, get LLM response, and send TTS to device
-def transcribe_respond(queue, tts, llm, config):
-    tic = time.time()
-    audio_model = whisper.load_model(config['transcribe']['whisper_model'])
-    print(
-        f"\n🎤 Loaded Whisper model [bold]{config['transcribe']['whisper_model']}[/] in {time.time()-tic:.3f} seconds\n"
-    )
-
+# utterances are handed to a pool of pipeline workers, keeping each device's utterances in order
+def transcribe_respond(queue, responder, config):
+    pool = PipelinePool(responder, config)
+    pool.start()
     while True:
-        while queue.empty():
-            time.sleep(0.01)
-
-        data, device, last_one = queue.get()
-        tic = time.time()
-
-        with warnings.catch_warnings():  # stop repeated warnings from Whisper
-            warnings.simplefilter("ignore")
-            res = audio_model.transcribe(
-                data.astype(np.float32) / 32768.0, initial_prompt=device.last_response
-            )
-
-        if "text" in res:
-            if res["segments"]:
-                device.log.debug(f"Transcription time: {time.time()-tic:.3f}")
-                if res["segments"][0]["no_speech_prob"] < config['transcribe']['no_speech_prob']:
-                    new_res = res["text"].strip()
-                    device.log.info(
-                        f"[dim]Transcribed:[/] {new_res} ({res['segments'][0]['no_speech_prob']:.2f})"
-                        + ("" if last_one else "[INCOMPLETE]")
-                    )
-                    if last_one:
-                        device.stop_listening()  # while server is "thinking"
-                        text_response = llm.ask_kobold(device, new_res)
-                        device.last_response = text_response  # use this as prompt for next Whisper transcription
-                        wav_fname = tts.text_to_speech(
-                            device, text_response, path_name=config['audio_dir']
-                        )
-                        if wav_fname:
-                            device.send_audio(wav_fname, mic_timeout=10)
-                        else:
-                            # TODO: send placeholder response saying there's an issue
-                            device.log.warning(f"No audio sent")
-                        device.prune_messages()
-                else:
-                    device.log.debug(
-                        f"[NO SPEECH] {res['text'].strip()} ({res['segments'][0]['no_speech_prob']:.2f})"
-                    )
-            else:
-                device.log.debug(f"No result")
-        else:
-            device.log.warning("No text")
+        pool.put(queue.get())  # blocks until an utterance is ready, no polling
         queue.task_done()
 
 
@@ -224,12 +95,16 @@ class ConfigUpdater:
                     self.config['use_notes'] = value
                 elif key == 'whisper':
                     self.config['transcribe']['whisper_model'] = value
+                elif key == 'asr':
+                    self.config['transcribe']['backend'] = value
                 elif key == 'max_messages':
                     self.config['llm']['max_messages'] = int(value)
                 elif key == 'voice':
                     self.config['kokoro_default_voice'] = value
                 elif key == 'send':
                     self.config['maubot']['send_replies'] = value
+                elif key == 'runtime':
+                    self.config['runtime'] = value
                 else:
                     print(f"[blink red] Unknown config key:[/] {key} - see examples in {__file__}:{sys._getframe().f_lineno}")
 
@@ -274,10 +149,18 @@ def main(**kwargs):
 
     show_git_hash()
 
-    queue = Queue()
     manager = DeviceManager(config)
     tts = KokoroTTS(config)
+    atexit.register(tts.report)
+    if config.get('tts', {}).get('cache', {}).get('enabled', False):
+        tts = TTSCache(tts, config)
+        atexit.register(tts.report)
     llm = KoboldCPPConnector(config)
+    responder = Responder(tts, llm, config)
+    if isinstance(tts, TTSCache):
+        tts.start(responder.limits['tts'])
+    leds = LedDispatcher(config)  # Visualize speaking (and server listening) on LED's
+    leds.start()
 
     # Send welcome message to each known device on startup
     for device in manager.devices.values():
@@ -290,10 +173,23 @@ def main(**kwargs):
 
 
     atexit.register(manager.save_to_json) 
+    atexit.register(llm.http.report)
+    atexit.register(llm.cache.report)
+    atexit.register(llm.speculator.report)
+    atexit.register(llm.scheduler.report)
+
+    if config.get('runtime', 'threads') == 'asyncio':
+        import aio_server
+        try:
+            asyncio.run(aio_server.serve(manager, responder, leds, config))
+        except KeyboardInterrupt:
+            pass
+        return
 
+    queue = Queue()
     threads = [
-        threading.Thread(target=listen_detect, args=(queue, manager, config), daemon=True),
-        threading.Thread(target=transcribe_respond, args=(queue, tts, llm, config), daemon=True),
+        threading.Thread(target=listen_detect, args=(queue, manager, leds, config), daemon=True),
+        threading.Thread(target=transcribe_respond, args=(queue, responder, config), daemon=True),
         threading.Thread(target=multicast_listen, args=(manager,config), daemon=True),
     ]
 
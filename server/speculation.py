@@ -0,0 +1,84 @@
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from rich import print
+
+from llm_scheduler import SPECULATIVE
+
+class Speculator:
+    """Sends prompts built from partial transcriptions to KoboldCPP while the user is still talking.
+
+    `kobold.speculate.mode`:
+      "prefill"  - process the prompt and generate a single token, so KoboldCPP's cached context already covers
+                   the system prompt, history and most of the utterance when the final transcription arrives
+      "generate" - generate the full response, used as is if the final prompt turns out identical
+    Each device has at most one speculative request, superseded ones are stopped with /extra/abort using their genkey.
+    Speculative requests have low priority in the LLMScheduler, they're dropped when final requests are waiting.
+    """
+    def __init__(self, llm, config):
+        self.llm = llm
+        self.mode = config.get('kobold', {}).get('speculate', {}).get('mode', 'off')
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="speculate")
+        self.pending = {} # hostname -> (prompt, genkey, future)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hits = 0
+        self.aborted = 0
+
+    @property
+    def enabled(self):
+        return self.mode in ('prefill', 'generate')
+
+    def start(self, device, partial_text):
+        full_prompt, _ = self.llm.build_prompt(device, partial_text)
+        with self.lock:
+            pending = self.pending.get(device.hostname)
+        if pending is not None and pending[0] == full_prompt:
+            return # nothing new was transcribed
+        self.cancel(device)
+
+        genkey = f"onju-{uuid.uuid4().hex[:12]}"
+        overrides = {"genkey": genkey}
+        if self.mode == 'prefill':
+            overrides["max_length"] = 1
+        future = self.executor.submit(self.llm.generate_response, device, full_prompt, SPECULATIVE, **overrides)
+        with self.lock:
+            self.pending[device.hostname] = (full_prompt, genkey, future)
+            self.requests += 1
+        device.log.debug(f"Speculative {self.mode}: {partial_text}")
+
+    def take(self, device, full_prompt):
+        """Speculatively generated text for the final prompt, or None. Anything still running is aborted.
+        A speculation that was aborted or preempted returns an error rather than its partial text, and gives None."""
+        with self.lock:
+            pending = self.pending.pop(device.hostname, None)
+        if pending is None:
+            return None
+        prompt, genkey, future = pending
+        if self.mode == 'generate' and prompt == full_prompt:
+            generated_text = future.result()
+            if not generated_text.startswith("Error:"):
+                with self.lock:
+                    self.hits += 1
+                device.log.info("⚡ Using speculative response")
+                return generated_text
+        self.abort(genkey, future)
+        return None
+
+    def cancel(self, device):
+        with self.lock:
+            pending = self.pending.pop(device.hostname, None)
+        if pending is not None:
+            self.abort(pending[1], pending[2])
+
+    def abort(self, genkey, future):
+        if future.done():
+            return
+        self.llm.scheduler.abort(genkey)
+        with self.lock:
+            self.aborted += 1
+
+    def report(self):
+        if self.enabled:
+            print(f"[dim]⚡ Speculative {self.mode}: {self.requests} requests, {self.hits} used, {self.aborted} aborted[/]")
@@ -0,0 +1,78 @@
+import re
+
+def normalize(text):
+    return re.sub(r"[^\w\s]", "", text).lower().split()
+
+class IncrementalTranscription:
+    """Incremental transcription of one in-progress utterance using a LocalAgreement-2 policy.
+
+    Each partial transcription only decodes the audio after the committed prefix. Segments that two
+    consecutive hypotheses agree on are committed and never decoded again, except the last one, which
+    ends at the edge of the audio so far and may still change. When the utterance ends only the
+    uncommitted tail is left to transcribe, and it's skipped if it's shorter than `min_tail` seconds.
+    Segments at or above `no_speech_prob` are dropped, they're mostly Whisper hallucinating on silence.
+    """
+    def __init__(self, rate, no_speech_prob=1.0, min_tail=0.0):
+        self.rate = rate
+        self.no_speech_prob = no_speech_prob
+        self.min_tail = int(min_tail * rate)
+        self.reset()
+
+    def reset(self):
+        self.committed = [] # segment dicts that are final, with start/end relative to the utterance
+        self.committed_samples = 0 # audio before this offset is never decoded again
+        self.hypothesis = [] # uncommitted segments from the previous partial transcription
+
+    def committed_text(self):
+        return " ".join(segment["text"].strip() for segment in self.committed)
+
+    def prompt(self, initial_prompt):
+        # condition on what's already committed so the tail decodes as a continuation
+        return self.committed_text() or initial_prompt
+
+    def decode_tail(self, transcribe, data, initial_prompt):
+        offset = self.committed_samples / self.rate
+        res = transcribe(data[self.committed_samples:], self.prompt(initial_prompt))
+        segments = []
+        for segment in res.get("segments", []):
+            if segment.get("no_speech_prob", 0.0) >= self.no_speech_prob:
+                continue
+            segment = dict(segment)
+            segment["start"] = segment.get("start", 0) + offset
+            segment["end"] = segment.get("end", 0) + offset
+            segments.append(segment)
+        return segments
+
+    def update(self, transcribe, data, initial_prompt=None):
+        segments = self.decode_tail(transcribe, data, initial_prompt)
+
+        # LocalAgreement-2: commit the longest prefix of segments both hypotheses agree on
+        # but never the last segment, it's cut off by the end of the buffer and can change with more audio
+        agreed = 0
+        for previous, current in zip(self.hypothesis, segments[:-1]):
+            if normalize(previous["text"]) != normalize(current["text"]):
+                break
+            agreed += 1
+
+        if agreed:
+            self.committed += segments[:agreed]
+            self.committed_samples = min(len(data), int(segments[agreed - 1]["end"] * self.rate))
+        self.hypothesis = segments[agreed:]
+        return self.result(self.hypothesis)
+
+    def finish(self, transcribe, data, initial_prompt=None):
+        # end of speech, only the uncommitted tail still needs decoding
+        if len(data) - self.committed_samples < self.min_tail:
+            result = self.result([]) # too short to hold more than trailing silence
+        else:
+            result = self.result(self.decode_tail(transcribe, data, initial_prompt))
+        self.reset()
+        return result
+
+    def result(self, tail):
+        # same structure as a full Whisper transcription of the utterance
+        segments = self.committed + tail
+        return {
+            "text": " ".join(segment["text"].strip() for segment in segments),
+            "segments": segments,
+        }
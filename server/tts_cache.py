@@ -0,0 +1,176 @@
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
+
+from rich import print
+
+class TTSCache:
+    """Content-addressed cache of synthesized phrases in front of KokoroTTS, enabled with `tts.cache.enabled`.
+
+    Keys hash the text (whitespace normalized), voice, language and speed. Device-ready PCM is kept in an LRU
+    memory tier of `memory_mb`, backed by `.pcm` files in `dir` capped at `disk_mb` (least recently used removed first).
+    Only replies up to `max_chars` are cached, those are the short confirmations that repeat.
+    """
+    def __init__(self, tts, config):
+        settings = config.get('tts', {}).get('cache', {})
+        self.tts = tts
+        self.max_chars = settings.get('max_chars', 80)
+        self.memory_limit = settings.get('memory_mb', 32) * 1024 * 1024
+        self.disk_limit = settings.get('disk_mb', 256) * 1024 * 1024
+        self.dir = settings.get('dir', os.path.join(config['audio_dir'], 'tts_cache'))
+        os.makedirs(self.dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.memory = OrderedDict() # key -> PCM bytes
+        self.memory_bytes = 0
+        self.disk = OrderedDict() # key -> file size, least recently used first
+        for entry in sorted(os.scandir(self.dir), key=lambda e: e.stat().st_mtime):
+            if entry.name.endswith('.pcm'):
+                self.disk[entry.name[:-len('.pcm')]] = entry.stat().st_size
+        self.disk_bytes = sum(self.disk.values())
+
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+        self.bytes_served = 0
+        self.phrases = settings.get('prewarm') or []
+
+    def start(self, limit):
+        """Pre-warm in the background, synthesizing under the same limit as live replies so they aren't starved."""
+        if self.phrases:
+            threading.Thread(target=self.prewarm, args=(self.phrases, limit), name="tts-prewarm", daemon=True).start()
+
+    def key(self, device, text):
+        if len(text) > self.max_chars:
+            return None
+        text = re.sub(r"\s+", " ", text).strip()
+        voice_id = self.tts.get_voice_id(device)
+        lang_code = self.tts.get_lang_code(device)
+        return hashlib.sha1(f"{voice_id}|{lang_code}|{self.tts.speed}|{text}".encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dir, f"{key}.pcm")
+
+    def get(self, key):
+        with self.lock:
+            pcm = self.memory.get(key)
+            if pcm is not None:
+                self.memory.move_to_end(key)
+                self.hits['memory'] += 1
+                self.bytes_served += len(pcm)
+                return pcm
+            on_disk = key in self.disk
+        if on_disk:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    pcm = f.read()
+                os.utime(self.path(key))
+            except OSError:
+                pcm = None
+            if pcm is not None:
+                with self.lock:
+                    self.disk.move_to_end(key)
+                    self.hits['disk'] += 1
+                    self.bytes_served += len(pcm)
+                self.remember(key, pcm)
+                return pcm
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def remember(self, key, pcm):
+        with self.lock:
+            if key in self.memory:
+                return
+            self.memory[key] = pcm
+            self.memory_bytes += len(pcm)
+            while self.memory_bytes > self.memory_limit and self.memory:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+
+    def put(self, key, pcm):
+        self.remember(key, pcm)
+        try:
+            with open(self.path(key), 'wb') as f:
+                f.write(pcm)
+        except OSError as e:
+            print(f"[orange1]Failed to write TTS cache entry: {e}[/]")
+            return
+        evict = []
+        with self.lock:
+            self.disk_bytes += len(pcm) - self.disk.pop(key, 0)
+            self.disk[key] = len(pcm)
+            while self.disk_bytes > self.disk_limit and len(self.disk) > 1:
+                evicted, size = self.disk.popitem(last=False)
+                self.disk_bytes -= size
+                evict.append(evicted)
+        for evicted in evict:
+            try:
+                os.remove(self.path(evicted))
+            except OSError:
+                pass
+
+    def synthesize(self, device, text):
+        key = self.key(device, text)
+        pcm = self.get(key) if key else None
+        if pcm is None:
+            pcm = self.tts.synthesize(device, text)
+            if key and pcm:
+                self.put(key, pcm)
+        return pcm
+
+    def stream(self, device, text):
+        key = self.key(device, text)
+        pcm = self.get(key) if key else None
+        if pcm is not None:
+            yield pcm # playback starts right away
+            return
+        chunks = []
+        try:
+            for chunk in self.tts.pcm_segments(device, text):
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            device.log.error(f"Error generating speech: {str(e)}")
+            return # don't cache a partial reply
+        if key and chunks:
+            self.put(key, b"".join(chunks))
+
+    def prewarm(self, phrases, limit):
+        """Synthesize phrases ahead of time for every voice in voices.json, one at a time under limit."""
+        count = 0
+        for name in self.tts.voices:
+            device = SimpleNamespace(voice=name, hostname="prewarm")
+            for text in phrases:
+                key = self.key(device, text)
+                if key and key not in self.memory and key not in self.disk:
+                    with limit: # released after every phrase so live replies only ever wait for one
+                        pcm = self.tts.synthesize(device, text)
+                    if pcm:
+                        self.put(key, pcm)
+                        count += 1
+        print(f"🗣️  Pre-warmed TTS cache with {count} phrases")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits['memory'] + self.hits['disk'] + self.misses
+            return {
+                'memory_hits': self.hits['memory'],
+                'disk_hits': self.hits['disk'],
+                'misses': self.misses,
+                'hit_rate': (self.hits['memory'] + self.hits['disk']) / lookups if lookups else 0.0,
+                'bytes_served': self.bytes_served,
+                'memory_entries': len(self.memory),
+                'memory_bytes': self.memory_bytes,
+                'disk_entries': len(self.disk),
+                'disk_bytes': self.disk_bytes,
+            }
+
+    def report(self):
+        stats = self.stats()
+        print(f"[dim]🗣️  TTS cache: {stats['memory_hits']} memory hits, {stats['disk_hits']} disk hits, {stats['misses']} misses "
+              f"({100 * stats['hit_rate']:.0f}%), {stats['bytes_served'] / 1e6:.1f}MB served, "
+              f"{stats['memory_entries']} in memory ({stats['memory_bytes'] / 1e6:.1f}MB), "
+              f"{stats['disk_entries']} on disk ({stats['disk_bytes'] / 1e6:.1f}MB)[/]")
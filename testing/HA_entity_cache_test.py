@@ -0,0 +1,197 @@
+# HA_entity_cache_test.py
+"""
+Runs the Home Assistant entity cache against a local stub HA server (REST /api/states + websocket API).
+Covers the bulk load, state_changed events, reconnecting after a half-open websocket and the polling fallback.
+Run with `python HA_entity_cache_test.py` (or pytest) from this folder, needs websocket-client.
+"""
+import base64
+import hashlib
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+from home_assistant import EntityCache
+from http_client import Credentials, HomeAssistantClient
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class StubHomeAssistant:
+    """Just enough of Home Assistant: GET /api/states and the websocket auth/subscribe/ping handshake."""
+
+    def __init__(self):
+        self.states = {}
+        self.connections = []  # open websocket connections, newest last
+        self.silent = False  # stop answering on open websockets, like a host that went away without a FIN
+        self.lock = threading.Lock()
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def set_state(self, entity_id, state):
+        new_state = {"entity_id": entity_id, "state": state, "attributes": {},
+                     "last_updated": time.strftime("%Y-%m-%dT%H:%M:%S") + f".{time.time_ns() % 10**9:09d}"}
+        self.states[entity_id] = new_state
+        return new_state
+
+    def fire(self, entity_id, state):
+        """Change a state and send the state_changed event on the newest websocket."""
+        new_state = self.set_state(entity_id, state)
+        self.send(self.connections[-1], {"id": 1, "type": "event",
+                                         "event": {"data": {"entity_id": entity_id, "new_state": new_state}}})
+
+    def accept(self):
+        while True:
+            conn, _ = self.server.accept()
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            request += conn.recv(4096)
+        lines = request.decode().split("\r\n")
+        path = lines[0].split(" ")[1]
+        headers = {k.lower(): v.strip() for k, v in (line.split(":", 1) for line in lines[1:] if ":" in line)}
+        if path == "/api/websocket":
+            self.websocket(conn, headers["sec-websocket-key"])
+            return
+        body = json.dumps(list(self.states.values())).encode()
+        conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n"
+                     + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        conn.close()
+
+    def websocket(self, conn, key):
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        conn.sendall(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        self.send(conn, {"type": "auth_required"})
+        assert self.receive(conn)["access_token"] == "tok"
+        self.send(conn, {"type": "auth_ok"})
+        subscribe = self.receive(conn)
+        assert subscribe["type"] == "subscribe_events" and subscribe["event_type"] == "state_changed"
+        self.connections.append(conn)
+        self.send(conn, {"id": subscribe["id"], "type": "result", "success": True})
+        while True:
+            message = self.receive(conn)
+            if message is None:
+                return
+            if message.get("type") == "ping" and not self.silent:
+                self.send(conn, {"id": message["id"], "type": "pong"})
+
+    def send(self, conn, message):
+        payload = json.dumps(message).encode()
+        header = bytes([0x81, len(payload)]) if len(payload) < 126 else struct.pack("!BBH", 0x81, 126, len(payload))
+        with self.lock:
+            conn.sendall(header + payload)
+
+    def receive(self, conn):
+        def read(n):
+            data = b""
+            while len(data) < n:
+                chunk = conn.recv(n - len(data))
+                if not chunk:
+                    raise ConnectionError
+                data += chunk
+            return data
+        try:
+            opcode, length = read(2)
+            length &= 0x7F
+            if length == 126:
+                length = struct.unpack("!H", read(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", read(8))[0]
+            mask = read(4)
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(read(length)))
+        except (ConnectionError, OSError):
+            return None
+        if opcode & 0x0F == 0x8:  # close
+            return None
+        return json.loads(payload)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def make_cache(stub, **settings):
+    credentials_file = os.path.join(tempfile.mkdtemp(), "credentials.json")
+    with open(credentials_file, "w") as f:
+        json.dump({"home_assistant_url": f"http://127.0.0.1:{stub.port}/", "home_assistant_token": "tok"}, f)
+    client = HomeAssistantClient(Credentials(credentials_file), timeout=2)
+    return EntityCache(client, {"home_assistant": settings})
+
+
+def test_load():
+    stub = StubHomeAssistant()
+    stub.set_state("light.kitchen", "on")
+    stub.set_state("switch.bedroom_fan", "off")
+    cache = make_cache(stub)
+    cache.load()
+    assert cache.loaded
+    assert [s["entity_id"] for s in cache.all()] == ["light.kitchen", "switch.bedroom_fan"]
+    assert cache.state("light.kitchen") == "on"
+
+
+def test_state_changed_events():
+    stub = StubHomeAssistant()
+    stub.set_state("light.kitchen", "off")
+    cache = make_cache(stub)
+    changes = []
+    cache.on_change(lambda: changes.append(len(cache.all())))
+    cache.start()
+    assert wait_for(lambda: stub.connections and cache.loaded)
+
+    stub.fire("light.kitchen", "on")
+    assert wait_for(lambda: cache.state("light.kitchen") == "on")
+    assert changes == [1]  # the initial load, a state change doesn't add or remove entities
+
+    stub.fire("light.hallway", "on")
+    assert wait_for(lambda: cache.state("light.hallway") == "on")
+    assert changes == [1, 2]
+
+
+def test_reconnects_when_pings_go_unanswered():
+    stub = StubHomeAssistant()
+    stub.set_state("light.kitchen", "off")
+    cache = make_cache(stub, heartbeat=0.2)
+    cache.start()
+    assert wait_for(lambda: len(stub.connections) == 1 and cache.loaded)
+
+    stub.silent = True  # half-open: the socket stays up but nothing comes back
+    stub.set_state("light.kitchen", "on")  # changed while the cache wasn't hearing anything
+    assert wait_for(lambda: len(stub.connections) == 2)
+    stub.silent = False
+    assert wait_for(lambda: cache.state("light.kitchen") == "on")  # reloaded after reconnecting
+
+    stub.fire("light.kitchen", "off")
+    assert wait_for(lambda: cache.state("light.kitchen") == "off")
+
+
+def test_poll_fallback():
+    stub = StubHomeAssistant()
+    stub.set_state("light.kitchen", "off")
+    cache = make_cache(stub, refresh="poll", poll_interval=0.1)
+    cache.load()
+    cache.start()
+    stub.set_state("light.kitchen", "on")
+    assert wait_for(lambda: cache.state("light.kitchen") == "on")
+    assert not stub.connections
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✅ {name}")
@@ -0,0 +1,93 @@
+# intents_test.py
+"""
+Checks the intent router against a handful of entities, without Home Assistant.
+Run with `python intents_test.py` (or pytest) from this folder.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+from intents import IntentRouter
+
+
+class StubEntities:
+    """The parts of EntityCache the router uses."""
+
+    def __init__(self, states):
+        self.states = {s["entity_id"]: s for s in states}
+
+    def on_change(self, callback):
+        pass
+
+    def domain(self, domain):
+        return [s for s in self.states.values() if s["entity_id"].startswith(f"{domain}.")]
+
+    def get(self, entity_id):
+        return self.states.get(entity_id)
+
+    def state(self, entity_id):
+        return (self.states.get(entity_id) or {}).get("state")
+
+
+def entity(entity_id, friendly_name, state="off", **attributes):
+    return {"entity_id": entity_id, "state": state, "attributes": {"friendly_name": friendly_name, **attributes}}
+
+
+def make_router(*states):
+    return IntentRouter(StubEntities(states), {})
+
+
+HOME = [
+    entity("light.living_room_rgbww_lights", "Living Room RGBWW Lights", min_color_temp_kelvin=2000),
+    entity("light.bedroom_lamp", "Bedroom Lamp"),
+    entity("switch.bedroom_fan", "Bedroom Fan", state="on"),
+]
+
+
+def test_single_fan_by_generic_name():
+    router = make_router(*HOME)
+    assert router.route("Turn off the fan.") == (
+        "Bedroom Fan turned off.",
+        [{"name": "control_fan", "arguments": {"entity_id": "switch.bedroom_fan", "state": "off"}}],
+    )
+    assert router.route("turn on the fan please")[1] == [
+        {"name": "control_fan", "arguments": {"entity_id": "switch.bedroom_fan", "state": "on"}}
+    ]
+    assert router.route("Is the fan on?") == ("Yes, it's on.", [])
+
+
+def test_several_fans_need_a_name_or_plural():
+    router = make_router(*HOME, entity("switch.office_fan", "Office Fan"))
+    assert router.route("turn off the fan") is None
+    assert router.route("turn off the office fan")[1] == [
+        {"name": "control_fan", "arguments": {"entity_id": "switch.office_fan", "state": "off"}}
+    ]
+    spoken, calls = router.route("turn off all the fans")
+    assert spoken == "Fans turned off."
+    assert sorted(c["arguments"]["entity_id"] for c in calls) == ["switch.bedroom_fan", "switch.office_fan"]
+
+
+def test_lights():
+    router = make_router(*HOME)
+    assert router.route("turn off the lights") == (
+        "Lights turned off.",
+        [{"name": "control_light", "arguments": {"entity_id": ["light.living_room_rgbww_lights", "light.bedroom_lamp"], "brightness": 0}}],
+    )
+    assert router.route("set the bedroom lamp to 30%")[1] == [
+        {"name": "control_light", "arguments": {"entity_id": ["light.bedroom_lamp"], "brightness": 76}}
+    ]
+    assert router.route("make the living room warm")[1][0]["name"] == "control_light_temperature"
+
+
+def test_falls_through_to_llm():
+    router = make_router(*HOME)
+    assert router.route("what's the weather like") is None
+    assert router.route("turn off the kettle") is None
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✅ {name}")